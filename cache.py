@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import collections
+
+class LRUCache(object):
+    '''Dict-like cache that keeps only the maxsize most recently used keys'''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+    def __len__(self):
+        return len(self.items)
+    def __contains__(self, key):
+        return key in self.items
+    def __getitem__(self, key):
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+    def __setitem__(self, key, value):
+        if key in self.items:
+            del self.items[key]
+        elif len(self.items) >= self.maxsize:
+            self.items.popitem(last=False)
+        self.items[key] = value
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    def clear(self):
+        self.items.clear()
+
+if __name__ == '__main__':
+    c = LRUCache(2)
+    c[1] = 'a'
+    c[2] = 'b'
+    assert c[1] == 'a'
+    c[3] = 'c'
+    assert 2 not in c
+    assert 1 in c and 3 in c
+    assert len(c) == 2
+    assert c.get(2, 'z') == 'z'
+    c[1] = 'A'
+    c[4] = 'd'
+    assert 3 not in c
+    assert c[1] == 'A'
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+from array import array
+import multiprocessing
+
+# Collatz chain lengths, evaluated iteratively: walk the chain until it reaches a
+# value whose length is known, then assign lengths back along the path. Lengths
+# of values below the limit live in a compact array of unsigned shorts. Values
+# above it go to a bounded cache of two dict generations, an approximate LRU:
+# hits in the old generation are promoted, and when the young one fills up the
+# old one is dropped (checked once per call, so a generation can overshoot by
+# one chain). An odd n is always followed by the even 3n + 1, so that step is
+# taken without a lookup. The shared engine behind collatz_length is only
+# allocated on first use.
+
+class Collatz(object):
+    def __init__(self, limit=1 << 22, maxsize=1 << 16):
+        self.limit = max(limit, 2)
+        self.table = array('H', [0]) * self.limit
+        self.table[1] = 1
+        self.generation = max(maxsize // 2, 1)
+        self.young, self.old = {}, {}
+    def length(self, n):
+        'n -> number of terms in the Collatz chain starting at n, including n and 1'
+        if n < 1:
+            raise ValueError('No Collatz chain starting at {0}'.format(n))
+        table, limit, young, old = self.table, self.limit, self.young, self.old
+        if n < limit and table[n]:
+            return table[n]
+        path = []
+        append = path.append
+        while True:
+            if n < limit:
+                known = table[n]
+                if known:
+                    break
+            elif n in young:
+                known = young[n]
+                break
+            elif n in old:
+                known = young[n] = old[n]
+                break
+            append(n)
+            if n & 1:
+                n = 3 * n + 1
+                append(n)
+            n >>= 1
+        for m in reversed(path):
+            known += 1
+            if m < limit:
+                table[m] = known
+            else:
+                young[m] = known
+        if len(young) >= self.generation:
+            self.old, self.young = young, {}
+        return known
+    def lengths(self, start, stop):
+        'start, stop -> array of chain lengths for xrange(start, stop)'
+        if start < min(stop, 1):
+            raise ValueError('No Collatz chain starting at {0}'.format(start))
+        table, limit, length_of = self.table, self.limit, self.length
+        return array('H', (n < limit and table[n] or length_of(n) for n in xrange(start, stop)))
+    def longest(self, start, stop):
+        'start, stop -> (n, length) for the first n in xrange(start, stop) with the longest chain'
+        if start < min(stop, 1):
+            raise ValueError('No Collatz chain starting at {0}'.format(start))
+        best, best_length = None, 0
+        table, limit, length_of = self.table, self.limit, self.length
+        for n in xrange(start, stop):
+            length = n < limit and table[n] or length_of(n)
+            if length > best_length:
+                best, best_length = n, length
+        return best, best_length
+
+engine = None
+
+def collatz_length(n):
+    global engine
+    if engine is None:
+        engine = Collatz()
+    return engine.length(n)
+
+def _split_range(start, stop, workers):
+    size = max(1, -(-(stop - start) // workers))
+    return [(a, min(a + size, stop)) for a in xrange(start, stop, size)]
+
+def _lengths_in((start, stop)):
+    return Collatz().lengths(start, stop)
+
+def _longest_in((start, stop)):
+    return Collatz().longest(start, stop)
+
+def _map(func, start, stop, workers):
+    if workers is None:
+        workers = 1 if multiprocessing.current_process().daemon else multiprocessing.cpu_count()
+    tasks = _split_range(start, stop, workers)
+    if workers <= 1 or len(tasks) <= 1:
+        return map(func, tasks)
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(func, tasks)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def collatz_lengths(start, stop, workers=None):
+    'start, stop -> array of chain lengths for xrange(start, stop), computed on workers processes'
+    result = array('H')
+    for lengths in _map(_lengths_in, start, stop, workers):
+        result.extend(lengths)
+    return result
+
+def longest_chain(start, stop, workers=None):
+    'start, stop -> (n, length) for the first n in xrange(start, stop) with the longest chain, computed on workers processes'
+    return max(_map(_longest_in, start, stop, workers), key=lambda (n, length): length)
+
+if __name__ == '__main__':
+    from jtest import BaseTest, returns, raises, color
+    import sys
+
+    class Test(BaseTest):
+        pass
+
+    class TestCollatz(Test):
+        @returns([1, 2, 8, 3, 6, 9, 17, 4, 20])
+        def lengths(self):
+            return list(Collatz().lengths(1, 10))
+        @returns((10, 112))
+        def length(self):
+            return collatz_length(13), collatz_length(27)
+        @returns(True)
+        def small_table(self):
+            return Collatz(limit=10, maxsize=4).lengths(1, 1000) == Collatz().lengths(1, 1000)
+        @raises(ValueError)
+        def zero(self):
+            return collatz_length(0)
+        @raises(ValueError)
+        def negative(self):
+            return Collatz().lengths(-5, 5)
+        @raises(ValueError)
+        def negative_cached(self):
+            engine = Collatz(limit=16)
+            engine.lengths(1, 16)
+            return engine.longest(-3, 5)
+        @returns((6171, 262))
+        def longest(self):
+            return Collatz().longest(1, 10000)
+        @returns((6171, 262))
+        def longest_chain(self):
+            return longest_chain(1, 10000, workers=3)
+        @returns(True)
+        def collatz_lengths(self):
+            return collatz_lengths(1, 5000, workers=2) == Collatz().lengths(1, 5000)
+
+    color.ENABLED = sys.stdout.isatty()
+    BaseTest.run_all_tests(base_class=Test, g=globals())
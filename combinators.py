@@ -2,6 +2,9 @@
 
 from itertools import count, takewhile, izip
 
+from cache import LRUCache
+from factorize import prime_factors
+
 S = (lambda f: 
         (lambda x: f(f, x)))
 Y = (lambda F: 
@@ -12,6 +15,61 @@ Y = (lambda F:
 #S = lambda f: (lambda *a, **k: f(f, *a, **k))
 #Y = lambda F: (lambda g: g(g))(lambda f: F(lambda *a, **k: f(f)(*a, **k)))
 
+# Memoizing variants: the recursive calls go through one wrapper that looks the
+# argument up in cache first. Any dict-like object works as the cache, e.g. a
+# cache.LRUCache to bound it. They still recurse, two frames per level: from a
+# cold cache, fib3(1000) runs past the default recursion limit and raises
+# RuntimeError. Filling the cache bottom up (e.g. map(fib3, xrange(n)) first)
+# keeps every call shallow, as long as the cache holds the last few results.
+
+def Smemo(f, cache=None):
+    cache = {} if cache is None else cache
+    def m(self, x):
+        try:
+            return cache[x]
+        except KeyError:
+            result = cache[x] = f(m, x)
+            return result
+    return lambda x: m(m, x)
+
+def Ymemo(F, cache=None):
+    cache = {} if cache is None else cache
+    def m(x):
+        try:
+            return cache[x]
+        except KeyError:
+            result = cache[x] = body(x)
+            return result
+    body = F(m)
+    return m
+
+# Trampolined variants for tail-recursive definitions: the recursive call only
+# returns a Bounce with its arguments, and a loop keeps calling the body until
+# it returns anything else, so the stack doesn't grow with the input.
+
+class Bounce(object):
+    __slots__ = ('args',)
+    def __init__(self, args):
+        self.args = args
+
+def Stramp(f):
+    bounce = lambda self, *a: Bounce(a)
+    def run(*a):
+        result = f(bounce, *a)
+        while type(result) is Bounce:
+            result = f(bounce, *result.args)
+        return result
+    return run
+
+def Ytramp(F):
+    body = F(lambda *a: Bounce(a))
+    def run(*a):
+        result = body(*a)
+        while type(result) is Bounce:
+            result = body(*result.args)
+        return result
+    return run
+
 def last(seq):
     for item in seq:
         pass
@@ -20,7 +78,21 @@ def last(seq):
 sqrange = lambda n: takewhile(lambda a: a * a <= n, count(1))
 factors = lambda n: (v for v in sqrange(n) if not n % v)
 take    = lambda n, seq: (lambda i: (i.next() for _ in xrange(n)))(iter(seq))
-ffac    = lambda n: last(take(2, factors(n)))
+
+# ffac factorizes n once and keeps the factors of both halves of the split in a
+# small LRU cache, so the recursive calls of pfac* on them are lookups instead
+# of another prime_factors each.
+
+_factored = LRUCache(1024)
+
+def ffac(n):
+    'n -> smallest factor of n above 1, or 1 if n is prime'
+    factors = _factored.get(n) or prime_factors(n)
+    if len(factors) < 2:
+        return 1
+    _factored[factors[0]] = factors[:1]
+    _factored[n // factors[0]] = factors[1:]
+    return factors[0]
 
 pfac1   = S(lambda f, n:
             (lambda i: [n] if i == 1 else f(f, i) + f(f, n / i))(ffac(n)))
@@ -34,10 +106,19 @@ fact1   = S(lambda f, n:
 fact2   = Y(lambda f: lambda n: 
             1 if n == 1 else n * f(n - 1))
             
+fact3   = Stramp(lambda f, n, acc=1:
+            acc if n <= 1 else f(f, n - 1, acc * n))
+fact4   = Ytramp(lambda f: lambda n, acc=1:
+            acc if n <= 1 else f(n - 1, acc * n))
+            
 fib1    = S(lambda f, n:
             1 if n < 2 else f(f, n - 1) + f(f, n - 2))
 fib2    = Y(lambda f: lambda n:
             1 if n < 2 else f(n - 1) + f(n - 2))
+fib3    = Smemo(lambda f, n:
+            1 if n < 2 else f(f, n - 1) + f(f, n - 2))
+fib4    = Ymemo(lambda f: lambda n:
+            1 if n < 2 else f(n - 1) + f(n - 2))
 
 if __name__ == '__main__':
     assert list(sqrange(10)) == [1, 2, 3]
@@ -60,11 +141,45 @@ if __name__ == '__main__':
     assert pfac3(160) == [2, 2, 2, 2, 2, 5]
     assert pfac3(123456789012345) == [3, 5, 283, 3851, 7552031]
     assert pfac3(123456789012) == [2, 2, 3, 10288065751]
+    assert pfac3(2 * 997 * 997) == [2, 997, 997]
+    
+    factorize_all, calls = prime_factors, []
+    prime_factors = lambda n: calls.append(n) or factorize_all(n)
+    assert pfac1(123456789012345) == [3, 5, 283, 3851, 7552031]
+    assert pfac2(2 * 997 * 997) == [2, 997, 997]
+    assert calls == [123456789012345, 2 * 997 * 997]
+    prime_factors = factorize_all
     
     assert fact1(4) == 24
     assert fact2(4) == 24
     
     assert fib1(4) == 5
     assert fib2(4) == 5
+    assert fib3(4) == 5
+    assert fib4(4) == 5
+    assert fib3(100) == 573147844013817084101
+    assert fib4(100) == 573147844013817084101
+
+    fib5 = Ymemo(lambda f: lambda n: 1 if n < 2 else f(n - 1) + f(n - 2), LRUCache(3))
+    assert fib5(200) == fib4(200)
+
+    def raises(exc, f, *a):
+        try:
+            f(*a)
+        except exc:
+            return True
+        return False
+    cold3 = Smemo(lambda f, n: 1 if n < 2 else f(f, n - 1) + f(f, n - 2))
+    cold4 = Ymemo(lambda f: lambda n: 1 if n < 2 else f(n - 1) + f(n - 2))
+    assert raises(RuntimeError, cold3, 1000)
+    assert raises(RuntimeError, cold4, 1000)
+    fib6 = Ymemo(lambda f: lambda n: 1 if n < 2 else f(n - 1) + f(n - 2), LRUCache(3))
+    assert last(map(fib3, xrange(1001))) == last(map(fib6, xrange(1001))) == fib3(999) + fib3(998)
+    
+    import math
+    assert fact3(4) == 24
+    assert fact4(4) == 24
+    assert fact3(5000) == math.factorial(5000)
+    assert fact4(5000) == math.factorial(5000)
     
     
\ No newline at end of file
@@ -2,8 +2,18 @@
 
 from jtest import BaseTest, returns, raises, color
 from pyquery import Query
+from sieve import primes, primes_below, nth_prime
+from factorize import prime_factors, FactorTable
+from collatz import collatz_length, longest_chain
+from sequences import Fibonacci, fib_index_with_digits
 from itertools import count
+import getopt
+import json
+import os
+import resource
+import subprocess
 import sys
+import timeit
 
 class Tests(BaseTest):
     pass
@@ -32,40 +42,13 @@ def result_of(*args):
 ###############################################################################    
     
 def fibonacci():
-	m, n = 0, 1
-	while True:
-		m, n = n, m + n
-		yield m
-
-def primes():
-    p = [2, 3]
-    n = 5
-    s = 2
-    yield 2
-    yield 3
-    while True:
-        b = True
-        for i in p:
-            b = (n % i)
-            if not b:
-                break
-            if i * i >= n:
-                break
-        if b:
-            p.append(n)
-            yield n
-        n += s
-        s ^= 6
-        
+    return Fibonacci(1)
+
 def factors(n):
     return Query(count(1)) \
         .take_while(lambda i: i * i <= n) \
         .where(lambda i: n % i == 0)
 
-def prime_factors(n):
-    first = Query(factors(n)).take(2).last()
-    return [n] if first == 1 else (prime_factors(first) + prime_factors(n / first))
-
 def collatz(n):
     while True:
         yield n
@@ -76,14 +59,8 @@ def collatz(n):
         else:
             n = n / 2
 
-def collatz_len(n, cache={1:1}):
-    if n in cache:
-        return cache[n]
-    if n & 1:
-        cache[n] = 1 + collatz_len(3 * n + 1)
-    else:
-        cache[n] = 1 + collatz_len(n / 2)
-    return cache[n]
+def collatz_len(n):
+    return collatz_length(n)
 
 
 ###############################################################################    
@@ -126,12 +103,10 @@ def euler_004(n):
 @test(2520, 10)
 def euler_005(n):
     'n -> smallest number divisible by each of the numbers 1 to n'
+    table = FactorTable(n + 1)
     factors = {}
     for i in xrange(2,n+1):
-        for k,g in Query(prime_factors(i)) \
-                .group_by() \
-                .to_dict(lambda (k,g): k, lambda (k,g): g.count()) \
-                .items():
+        for k,g in table.factor_counts(i):
             if k not in factors or g > factors[k]:
                 factors[k] = g
     return Query(factors.items()) \
@@ -148,17 +123,15 @@ def euler_006(n):
 @test(13, 5)
 def euler_007(n):
     "n -> n'th prime"
-    return Query(primes()).element_at(n)
+    return nth_prime(n + 1)
 
 @result_of(5)
 @test(81, 2)
 def euler_008(n):
     'n -> largest product of n consecutive digits in the 1000-digit number'
     s = '7316717653133062491922511967442657474235534919493496983520312774506326239578318016984801869478851843858615607891129494954595017379583319528532088055111254069874715852386305071569329096329522744304355766896648950445244523161731856403098711121722383113622298934233803081353362766142828064444866452387493035890729629049156044077239071381051585930796086670172427121883998797908792274921901699720888093776657273330010533678812202354218097512545405947522435258490771167055601360483958644670632441572215539753697817977846174064955149290862569321978468622482839722413756570560574902614079729686524145351004748216637048440319989000889524345065854122758866688116427171479924442928230863465674813919123162824586178664583591245665294765456828489128831426076900422421902267105562632111110937054421750694165896040807198403850962455444362981230987879927244284909188845801561660979191338754992005240636899125607176060588611646710940507754100225698315520005593572972571636269561882670428252483600823257530420752963450'
-    return Query(xrange(len(s)-n+1)) \
-        .select(lambda i: s[i:i+n]) \
-        .select_many(lambda s: s.split(), lambda s,i: i) \
-        .select(lambda s: Query(s).select(int).aggregate(lambda a, b: a * b, 1)) \
+    return Query(s) \
+        .rolling_product(n, int) \
         .max()
 
 @result_of(1000)
@@ -176,24 +149,98 @@ def euler_009(n):
 @test(17, 10)
 def euler_010(n):
     'n -> sum of all the primes below n'
-    return Query(primes()) \
-        .take_while(lambda i: i < n) \
-        .sum()
+    return Query(primes_below(n)).sum()
 
 @result_of(1000000)
 def euler_014(n):
-    return max(xrange(1,n), key=collatz_len)
+    return longest_chain(1, n)[0]
 
 @result_of(1000)
 @test(12, 3)
 def euler_025(n):
     'n -> first term in the Fibonacci sequence to contain n digits'
-    return Query(fibonacci()) \
-        .take_while(lambda i: len(str(i)) < n) \
-        .count() + 1
+    return fib_index_with_digits(n)
 
 ###############################################################################    
 
+def measure(name):
+    'name -> (wall seconds, peak RSS growth in KiB) of one call of a solver, run in a fresh interpreter'
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--benchmark', '--measure=' + name],
+        stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise RuntimeError('{0} failed'.format(name))
+    return tuple(json.loads(output))
+
+def measure_here(name):
+    'name -> (wall seconds, peak RSS growth in KiB) of one call of a solver in this process, counting its worker processes'
+    method = getattr(Results(), name)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = timeit.default_timer()
+    method()
+    elapsed = timeit.default_timer() - start
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return elapsed, max(peak - before, 0)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, int(-(-p * len(values) // 100)) - 1)]
+
+def benchmark(repeat=5):
+    'repeat -> { solver name: timing summary } for every solver registered with @result_of'
+    results = {}
+    for name in sorted(name for name in dir(Results) if name.startswith('euler_')):
+        runs = [measure(name) for _ in xrange(repeat)]
+        times = [elapsed for (elapsed, peak) in runs]
+        results[name] = {
+            'runs': repeat,
+            'min': min(times),
+            'median': percentile(times, 50),
+            'p95': percentile(times, 95),
+            'peak_kb': max(peak for (elapsed, peak) in runs) }
+        print '  {0}{1}{2} min {3:.4f}s; median {4:.4f}s; p95 {5:.4f}s; peak {6} KiB'.format(
+            color(color.FG_GREEN, color.BOLD), name, color(color.DEFAULT),
+            results[name]['min'], results[name]['median'], results[name]['p95'], results[name]['peak_kb'])
+    return results
+
+def regressions(results, baseline, threshold=0.25, min_delta=0.001):
+    'results, baseline -> names of solvers whose median is more than threshold (and min_delta seconds) slower than in baseline'
+    slower = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        median, base = results[name]['median'], baseline[name]['median']
+        ratio = median / max(base, 1e-9)
+        slow = ratio > 1 + threshold and median - base > min_delta
+        print '  {0}{1}{2} {3:.2f}x baseline median'.format(
+            color(color.FG_RED if slow else color.FG_GREEN, color.BOLD), name, color(color.DEFAULT), ratio)
+        if slow:
+            slower.append(name)
+    return slower
+
+def benchmark_main(args):
+    opts = dict(getopt.getopt(args, '', ['benchmark', 'measure=', 'repeat=', 'save=', 'baseline=', 'threshold='])[0])
+    if '--measure' in opts:
+        print json.dumps(measure_here(opts['--measure']))
+        return 0
+    print color(color.FG_BROWN, color.BOLD) + 'Benchmark' + color(color.DEFAULT)
+    results = benchmark(int(opts.get('--repeat', 5)))
+    if '--save' in opts:
+        with open(opts['--save'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if '--baseline' in opts:
+        with open(opts['--baseline']) as f:
+            baseline = json.load(f)
+        print
+        print color(color.FG_BROWN, color.BOLD) + 'Baseline' + color(color.DEFAULT)
+        slower = regressions(results, baseline, float(opts.get('--threshold', 0.25)))
+        print
+        print 'regressions: {0}/{1}; slower: {2}'.format(len(slower), len(results), ', '.join(slower))
+        return 1 if slower else 0
+    return 0
+
 if __name__ == '__main__':
     color.ENABLED = sys.stdout.isatty()
+    if '--benchmark' in sys.argv[1:]:
+        sys.exit(benchmark_main(sys.argv[1:]))
     BaseTest.run_all_tests(base_class=BaseTest, g=globals())
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+from array import array
+from fractions import gcd
+from itertools import count
+
+from cache import LRUCache
+from sieve import isqrt, primes_below, small_primes
+
+# Integer factorization: trial division by the primes below TRIAL_LIMIT, then a
+# deterministic Miller-Rabin test and Pollard's rho (Brent's variant) for the
+# cofactor. Results can be memoized in one cache shared by every module that
+# imports prime_factors from here (euler, combinators); see use_cache().
+
+TRIAL_LIMIT = 1000
+TRIAL_PRIMES = [2] + small_primes(TRIAL_LIMIT)
+
+# These bases make Miller-Rabin exact for every n below 3317044064679887385961981;
+# above that the test is a strong probable-prime test.
+MILLER_RABIN_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+
+cache = None
+
+def use_cache(maxsize=None):
+    'maxsize -> memoize prime_factors in an LRU cache of maxsize entries, or a dict if maxsize is None; 0 disables'
+    global cache
+    if maxsize == 0:
+        cache = None
+    elif maxsize is None:
+        cache = {}
+    else:
+        cache = LRUCache(maxsize)
+    return cache
+
+def is_prime(n):
+    'n -> whether n is prime'
+    if n < 2:
+        return False
+    for p in TRIAL_PRIMES[:len(MILLER_RABIN_BASES)]:
+        if n % p == 0:
+            return n == p
+    d, s = n - 1, 0
+    while not d & 1:
+        d >>= 1
+        s += 1
+    for a in MILLER_RABIN_BASES:
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in xrange(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+def pollard_brent(n):
+    'n -> a non-trivial factor of the odd composite n'
+    if n < 2:
+        raise ValueError('Cannot split {0}'.format(n))
+    for c in count(1):
+        y, r, q, g, m = 2, 1, 1, 1, 128
+        while g == 1:
+            x = y
+            for _ in xrange(r):
+                y = (y * y + c) % n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for _ in xrange(min(m, r - k)):
+                    y = (y * y + c) % n
+                    q = q * abs(x - y) % n
+                g = gcd(q, n)
+                k += m
+            r *= 2
+        if g == n:
+            g = 1
+            while g == 1:
+                ys = (ys * ys + c) % n
+                g = gcd(abs(x - ys), n)
+        if g != n:
+            return g
+
+def _split(n, result):
+    if n < 2:
+        raise ValueError('Cannot split {0}'.format(n))
+    if is_prime(n):
+        result.append(int(n))
+    else:
+        d = pollard_brent(n)
+        _split(d, result)
+        _split(n // d, result)
+
+def prime_factors(n):
+    'n -> prime factors of n in increasing order, with multiplicity'
+    if n < 1:
+        raise ValueError('Cannot factorize {0}'.format(n))
+    if cache is not None and n in cache:
+        return list(cache[n])
+    result, m = [], n
+    for p in TRIAL_PRIMES:
+        if p * p > m:
+            if m > 1:
+                result.append(m)
+            break
+        while m % p == 0:
+            result.append(p)
+            m //= p
+    else:
+        if m > 1:
+            _split(m, result)
+            result.sort()
+    if cache is not None:
+        cache[n] = tuple(result)
+    return result
+
+def first_factor(n):
+    'n -> smallest factor of n above 1, or 1 if n is prime'
+    factors = prime_factors(n)
+    return factors[0] if len(factors) > 1 else 1
+
+# Batch factorization over a range: FactorTable(n) sieves the smallest prime
+# factor of every number below n into an array, after which factorizing any of
+# them is a walk of O(log m) table lookups. Larger primes are sieved first so
+# the smaller ones overwrite them; entries left at 0 are primes.
+
+class FactorTable(object):
+    def __init__(self, n):
+        self.n = n
+        self.spf = array('i', [0]) * max(n, 2)
+        roots = [2] + small_primes(isqrt(max(n - 1, 0)) + 1)
+        for p in reversed(roots):
+            if p * p < n:
+                self.spf[p * p::p] = array('i', [p]) * len(xrange(p * p, n, p))
+    def smallest_factor(self, m):
+        'm -> smallest prime factor of m'
+        return self.spf[m] or m
+    def prime_factors(self, m):
+        'm -> prime factors of m in increasing order, with multiplicity'
+        if not 0 < m < self.n:
+            raise ValueError('Cannot factorize {0} with a table below {1}'.format(m, self.n))
+        result, spf = [], self.spf
+        while m > 1:
+            p = spf[m] or m
+            result.append(p)
+            m //= p
+        return result
+    def factor_counts(self, m):
+        'm -> [(p, e), ...] with m == product of p ** e, in increasing order of p'
+        result = []
+        for p in self.prime_factors(m):
+            if result and result[-1][0] == p:
+                result[-1] = (p, result[-1][1] + 1)
+            else:
+                result.append((p, 1))
+        return result
+    def factorizations(self, start, stop):
+        'start, stop -> (m, prime_factors(m)) for every m in xrange(start, stop)'
+        for m in xrange(max(start, 1), stop):
+            yield m, self.prime_factors(m)
+    def divisor_count(self, m):
+        result = 1
+        for (p, e) in self.factor_counts(m):
+            result *= e + 1
+        return result
+    def sigma(self, m):
+        'm -> sum of the divisors of m'
+        result = 1
+        for (p, e) in self.factor_counts(m):
+            result *= (p ** (e + 1) - 1) // (p - 1)
+        return result
+    def totient(self, m):
+        result = m
+        for (p, e) in self.factor_counts(m):
+            result = result // p * (p - 1)
+        return result
+
+def lcm_range(n):
+    'n -> smallest number divisible by each of the numbers 1 to n'
+    result = 1
+    for p in primes_below(n + 1):
+        q = p
+        while q * p <= n:
+            q *= p
+        result *= q
+    return result
+
+if __name__ == '__main__':
+    from jtest import BaseTest, returns, raises, color
+    import sys
+
+    class Test(BaseTest):
+        pass
+
+    class TestPrimality(Test):
+        @returns([2, 3, 5, 7, 11, 13, 17, 19, 23, 29])
+        def small(self):
+            return [n for n in xrange(30) if is_prime(n)]
+        @returns([False, False, False])
+        def carmichael(self):
+            return [is_prime(n) for n in (561, 41041, 3215031751)]
+        @returns([True, True, False])
+        def large(self):
+            return [is_prime(2 ** 61 - 1), is_prime(2 ** 89 - 1), is_prime((2 ** 61 - 1) * (2 ** 31 - 1))]
+
+    class TestFactorization(Test):
+        @returns([2, 2, 2, 2, 2, 5])
+        def small(self):
+            return prime_factors(160)
+        @returns([3, 5, 283, 3851, 7552031])
+        def trial_division(self):
+            return prime_factors(123456789012345)
+        @returns([2, 2, 3, 10288065751])
+        def large_prime_cofactor(self):
+            return prime_factors(123456789012)
+        @returns([1000000007, 1000000009])
+        def semiprime(self):
+            return prime_factors(1000000007 * 1000000009)
+        @returns([2147483647, 2305843009213693951])
+        def large_semiprime(self):
+            return prime_factors((2 ** 31 - 1) * (2 ** 61 - 1))
+        @returns([[], [2], [3], [2, 2]])
+        def tiny(self):
+            return [prime_factors(n) for n in (1, 2, 3, 4)]
+        @raises(ValueError)
+        def zero(self):
+            return prime_factors(0)
+        @returns(([997, 997], [2, 997, 997], [991, 997, 997]))
+        def largest_trial_prime_squared(self):
+            return prime_factors(997 * 997), prime_factors(2 * 997 * 997), prime_factors(991 * 997 * 997)
+        @raises(ValueError)
+        def split_one(self):
+            return pollard_brent(1)
+        @returns((2, 1))
+        def first_factor(self):
+            return first_factor(10), first_factor(5)
+        @returns(([3, 5, 283, 3851, 7552031], 1))
+        def cached(self):
+            use_cache(16)
+            try:
+                prime_factors(123456789012345).append(0)
+                return prime_factors(123456789012345), len(cache)
+            finally:
+                use_cache(0)
+
+    class TestFactorTable(Test):
+        def __init__(self):
+            self.table = FactorTable(1000)
+        @returns(True)
+        def prime_factors(self):
+            return all(self.table.prime_factors(m) == prime_factors(m) for m in xrange(1, 1000))
+        @returns([(2, 3), (3, 2), (5, 1)])
+        def factor_counts(self):
+            return self.table.factor_counts(360)
+        @returns(('[(2, 3), (3, 2), (5, 1)]', set([int])))
+        def plain_ints(self):
+            return repr(self.table.factor_counts(360)), set(map(type, self.table.prime_factors(2 * 3 * 163)))
+        @returns([(1, []), (2, [2]), (3, [3]), (4, [2, 2])])
+        def factorizations(self):
+            return list(self.table.factorizations(0, 5))
+        @returns((24, 1170, 96))
+        def derived(self):
+            return self.table.divisor_count(360), self.table.sigma(360), self.table.totient(360)
+        @returns((1, 1, 1, 2, 4))
+        def derived_small(self):
+            return self.table.divisor_count(1), self.table.sigma(1), self.table.totient(1), \
+                self.table.divisor_count(997), self.table.totient(5)
+        @raises(ValueError)
+        def out_of_range(self):
+            return self.table.prime_factors(1000)
+        @returns([1, 1, 2, 6, 12, 60, 2520, 232792560])
+        def lcm_range(self):
+            return [lcm_range(n) for n in (0, 1, 2, 3, 4, 5, 10, 20)]
+
+    color.ENABLED = sys.stdout.isatty()
+    BaseTest.run_all_tests(base_class=Test, g=globals())
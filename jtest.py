@@ -1,3 +1,16 @@
+import fnmatch
+import hashlib
+import itertools
+import json
+import math
+import marshal
+import multiprocessing
+import os
+import select
+import signal
+import sys
+import timeit
+import types
 
 def color(*c):
     return '\x1B[{0}m'.format(';'.join(map(str, c))) if color.ENABLED else ''
@@ -7,6 +20,12 @@ map(lambda (k, v): setattr(color, k, v), dict(DEFAULT=0, BOLD=1,
     BG_BLACK=40, BG_RED=41, BG_GREEN=42, BG_BROWN=43, BG_BLUE=44, BG_MAGENTA=45, BG_CYAN=46, BG_WHITE=47,
     ENABLED=True).items())	
 
+class TestTimeout(Exception):
+    pass
+
+def _timed_out(signum, frame):
+    raise TestTimeout('test took longer than its timeout')
+
 class BaseDec(object):
     def __init__(self, func):
         self.func = func
@@ -17,7 +36,7 @@ class BaseDec(object):
         new_func = self.func.__get__(object, type)
         return self.__class__(new_func)
 
-def returns(value):
+def returns(value, timeout=None):
     class returns_dec(BaseDec):
         is_test = True
         def __call__(self, *a, **k):
@@ -26,14 +45,15 @@ def returns(value):
                 assert result == value, \
                     'result: {0}; expected result: {1}'.format(result, value)
                 return result
-            except AssertionError:
+            except (AssertionError, TestTimeout):
                 raise
             except Exception as ex:
                 assert False, \
                     'raises: {0} ({1}); expected result: {2}'.format(type(ex).__name__, str(ex), value)    
+    returns_dec.expected, returns_dec.timeout = value, timeout
     return returns_dec
 
-def raises(exception_type):
+def raises(exception_type, timeout=None):
     class raises_dec(BaseDec):
         is_test = True
         def __call__(self, *a, **k):
@@ -41,29 +61,322 @@ def raises(exception_type):
                 result = self.func(*a, **k)
                 assert False, \
                     'result: {0}; expected exception: {1}'.format(result, exception_type.__name__)
-            except AssertionError:
+            except (AssertionError, TestTimeout):
                 raise
             except Exception as ex:
                 assert type(ex) == exception_type, \
                     'raises: {0} ({1}); expected exception: {2}'.format(type(ex).__name__, str(ex), exception_type.__name__)
                 return ex
+    raises_dec.expected, raises_dec.timeout = exception_type, timeout
     return raises_dec
 
+# Benchmarks run the test method number times per sample, for repeat samples or
+# until max_time seconds have passed; without a number, it is raised tenfold
+# until one sample takes about max_time / (2 * repeat). The result reports
+# operations per second and their relative standard deviation. Given a
+# baseline file (--bench-baseline=FILE, as written by --bench-save=FILE) a
+# benchmark fails when it is more than threshold slower than its baseline.
+# Benchmarks are never cached, and never run next to other tests on the pool.
+
+class Benchmark(object):
+    def __init__(self, times, number):
+        self.times, self.number = times, number
+        self.mean = sum(times) / len(times)
+        self.deviation = math.sqrt(sum((t - self.mean) ** 2 for t in times) / max(len(times) - 1, 1))
+        self.ops_per_sec = 1 / self.mean if self.mean else float('inf')
+    def __repr__(self):
+        return '{0:.1f} ops/sec +- {1:.1f}% ({2} x {3})'.format(
+            self.ops_per_sec, 100 * self.deviation / self.mean if self.mean else 0, len(self.times), self.number)
+    def compare(self, baseline, threshold):
+        '''Fail with AssertionError when slower than baseline ops/sec by more than threshold'''
+        assert self.ops_per_sec * (1 + threshold) >= baseline, \
+            '{0!r}; baseline: {1:.1f} ops/sec, {2:.0%} slower'.format(self, baseline, baseline / self.ops_per_sec - 1)
+
+def measure(func, number=None, repeat=5, max_time=1.0):
+    '''func -> Benchmark of calling func()'''
+    timer = timeit.default_timer
+    def sample(number):
+        start = timer()
+        for _ in xrange(number):
+            func()
+        return timer() - start
+    if number is None:
+        number = 1
+        while sample(number) < max_time / (2 * repeat):
+            number *= 10
+    times, deadline = [], timer() + max_time
+    for _ in xrange(repeat):
+        times.append(sample(number) / number)
+        if timer() > deadline:
+            break
+    return Benchmark(times, number)
+
+def benchmark(number=None, repeat=5, max_time=1.0, threshold=0.25, timeout=None):
+    class benchmark_dec(BaseDec):
+        is_test = True
+        is_benchmark = True
+        def __call__(self, *a, **k):
+            return measure(lambda: self.func(*a, **k), number, repeat, max_time)
+    benchmark_dec.expected, benchmark_dec.timeout = (number, repeat, max_time, threshold), timeout
+    benchmark_dec.threshold = threshold
+    return benchmark_dec
+
+_baselines = {}
+
+# Tests can run on a pool of worker processes, one task per test method. The
+# workers are forked after the tasks are collected, so they find the test
+# classes (and any lambdas in them) through the task list instead of pickling
+# them; each worker makes one instance per class and sends back the outcome
+# with the repr of its result. The parent prints outcomes in task order as
+# soon as they arrive. The workers are not daemonic, so tests may
+# start process pools of their own. Each worker reports over its own pipe
+# (sends there are unbuffered) the task it starts on; if it dies in a test
+# (a crash, os._exit or SystemExit) that task fails and a new worker is started.
+
+_tasks = []
+_instances = {}
+
+def options(argv=None):
+    'argv -> dict of the --name=value and --name arguments in argv (sys.argv by default); others are ignored'
+    result = {}
+    for arg in sys.argv[1:] if argv is None else argv:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            result[name] = value
+    return result
+
+def _run_task(index):
+    class_, name = _tasks[index]
+    if class_ not in _instances:
+        _instances[class_] = class_()
+    instance = _instances[class_]
+    return instance.run_test(getattr(instance, name))
+
+def _worker(tasks, results):
+    for index in iter(tasks.get, None):
+        results.send((index, None))
+        results.send((index, _run_task(index)))
+
+def _start_worker(tasks):
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_worker, args=(tasks, writer))
+    process.start()
+    writer.close()
+    return reader, process
+
+def _run_serial(tasks):
+    _tasks[:] = tasks
+    _instances.clear()
+    return itertools.imap(_run_task, xrange(len(tasks)))
+
+def _is_benchmark((class_, name)):
+    return getattr(getattr(class_, name), 'is_benchmark', False)
+
+def _run(tasks, workers):
+    timed = [ task for task in tasks if _is_benchmark(task) ]
+    others = [ task for task in tasks if not _is_benchmark(task) ]
+    if workers <= 1 or len(others) <= 1:
+        return _run_serial(tasks)
+    if not timed:
+        return _run_parallel(tasks, min(workers, len(tasks)))
+    others = iter(list(_run_parallel(others, min(workers, len(others)))))
+    timed = _run_serial(timed)
+    return (next(timed if _is_benchmark(task) else others) for task in tasks)
+
+def _run_parallel(tasks, workers):
+    _tasks[:] = tasks
+    _instances.clear()
+    task_queue = multiprocessing.Queue()
+    for index in xrange(len(tasks)):
+        task_queue.put(index)
+    for _ in xrange(workers):
+        task_queue.put(None)
+    sys.stdout.flush()
+    processes = dict(_start_worker(task_queue) for _ in xrange(workers))
+    try:
+        done, running = {}, {}
+        for index in xrange(len(tasks)):
+            while index not in done:
+                if not processes:
+                    raise RuntimeError('Test workers exited before running {0}'.format(tasks[index][1]))
+                for reader in select.select(list(processes), [], [])[0]:
+                    try:
+                        i, result = reader.recv()
+                    except EOFError:
+                        process = processes.pop(reader)
+                        process.join()
+                        reader.close()
+                        if reader in running:
+                            lost = RuntimeError('Test worker exited with code {0}'.format(process.exitcode))
+                            done[running.pop(reader)] = (False, repr(lost), 0.0, None)
+                            processes.update([_start_worker(task_queue)])
+                        continue
+                    if result is None:
+                        running[reader] = i
+                    else:
+                        del running[reader]
+                        done[i] = result
+            yield done.pop(index)
+    finally:
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+# Outcomes are cached between runs in a JSON file next to the test script. A
+# test's key hashes its code (and the code of functions it closes over), its
+# expected outcome and timeout, and the source of every .py file under the
+# script's directory (hidden directories aside), the script itself included, so
+# modules a test imports lazily or from a subpackage count too. A passed test whose key is
+# unchanged is not run again; failed tests always are. --no-cache runs every
+# test, --last-failed only the ones that failed last time (or all, if none
+# did), and --failed-first runs and prints those before the others.
+
+CACHE_FILE = '.jtest-cache'
+
+def _digest(obj, h, seen):
+    func = getattr(obj, 'func', obj)
+    func = getattr(func, 'im_func', func)
+    if not isinstance(func, types.FunctionType):
+        h.update(repr(func))
+    elif func not in seen:
+        seen.add(func)
+        h.update(marshal.dumps(func.func_code))
+        for cell in func.func_closure or ():
+            _digest(cell.cell_contents, h, seen)
+    h.update(repr((getattr(obj, 'expected', None), getattr(obj, 'timeout', None))))
+
+def _source_digest(directory):
+    h = hashlib.sha1()
+    for (path, dirs, files) in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if name.endswith('.py'):
+                with open(os.path.join(path, name), 'rb') as f:
+                    h.update(os.path.relpath(os.path.join(path, name), directory) + '\0' + f.read())
+    return h.hexdigest()
+
+class ResultCache(object):
+    '''Outcomes of the tests of one script, by class and test name'''
+    def __init__(self, script):
+        self.directory = os.path.dirname(os.path.abspath(script))
+        self.path = os.path.join(self.directory, CACHE_FILE)
+        self.script = os.path.basename(script)
+        self.sources = _source_digest(self.directory)
+        try:
+            with open(self.path) as f:
+                self.all = json.load(f)
+        except (IOError, ValueError):
+            self.all = {}
+        self.entries = self.all.setdefault(self.script, {})
+    def key(self, class_, name):
+        h = hashlib.sha1(self.sources)
+        _digest(getattr(class_, name), h, set())
+        return h.hexdigest()
+    def get(self, class_, name, key):
+        '''-> (passed, result repr, seconds) of the last run of a passed test with this key, or None'''
+        entry = self.entries.get(class_.__name__ + '.' + name)
+        if entry and entry['key'] == key and entry['passed'] and not _is_benchmark((class_, name)):
+            return True, entry['result'], entry['seconds'], None
+    def put(self, class_, name, key, (passed, result, seconds, ops_per_sec)):
+        self.entries[class_.__name__ + '.' + name] = dict(key=key, passed=passed, result=result, seconds=seconds)
+    def failed(self):
+        return set(test for (test, entry) in self.entries.iteritems() if not entry['passed'])
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump(self.all, f, indent=2, sort_keys=True)
+
+def _select(classes, cache, opts):
+    pattern = opts.get('select') or None
+    plan = [ (class_, class_.test_names(pattern)) for class_ in classes ]
+    if pattern:
+        plan = [ (class_, names) for (class_, names) in plan if names ]
+    failed = cache.failed() if cache else set()
+    is_failed = lambda class_, name: class_.__name__ + '.' + name in failed
+    if 'last-failed' in opts and failed:
+        plan = [ (class_, [ name for name in names if is_failed(class_, name) ]) for (class_, names) in plan ]
+        plan = [ (class_, names) for (class_, names) in plan if names ]
+    elif 'failed-first' in opts:
+        plan = [ (class_, sorted(names, key=lambda name: not is_failed(class_, name))) for (class_, names) in plan ]
+        plan.sort(key=lambda (class_, names): not any(is_failed(class_, name) for name in names))
+    return plan
+
+def test_line(name, passed, result):
+    return '  ' + color(color.FG_GREEN if passed else color.FG_RED, color.BOLD) + name + color(color.DEFAULT) \
+        + ' ' + result
+
+# Test discovery works from an index built as test classes are defined: the
+# metaclass records every class in definition order, and gives each one the
+# set of its test names, inherited ones included. Tests set on a class later
+# (euler's @test and @result_of) are added to the set by __setattr__.
+
+class TestIndex(type):
+    classes = []
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+        tests = set().union(*(getattr(base, '_tests', ()) for base in bases))
+        tests -= set(attrs)
+        tests |= set(name for (name, value) in attrs.iteritems() if _is_test(value))
+        type.__setattr__(cls, '_tests', tests)
+        TestIndex.classes.append(cls)
+    def __setattr__(cls, name, value):
+        type.__setattr__(cls, name, value)
+        if _is_test(value):
+            cls._tests.add(name)
+        else:
+            cls._tests.discard(name)
+    def __delattr__(cls, name):
+        type.__delattr__(cls, name)
+        cls._tests.discard(name)
+
+def _is_test(value):
+    return callable(value) and getattr(value, 'is_test', False)
+
 class BaseTest(object):
+    __metaclass__ = TestIndex
+    timeout = None
+
     @staticmethod
-    def run_all_tests(base_class, g=None):
-        if g is None: g = globals()
-        BaseTest.run_tests(*[ obj
-            for obj in g.itervalues()
-            if isinstance(obj, type)
-            if base_class in obj.__bases__ ])
+    def run_all_tests(base_class, g=None, **kwargs):
+        '''Run the subclasses of base_class, in order of definition; only those found in g, if given'''
+        BaseTest.run_tests(*[ class_
+            for class_ in TestIndex.classes
+            if base_class in class_.__bases__
+            if g is None or g.get(class_.__name__) is class_ ], **kwargs)
 
     @staticmethod
-    def run_tests(*classes):
-        tests_ok, tests_fail, tests_ran, failed = 0, 0, 0, []
-        for class_ in classes:
+    def run_tests(*classes, **kwargs):
+        opts = options()
+        if kwargs.get('select'):
+            opts['select'] = kwargs['select']
+        workers = kwargs.get('workers') or int(opts.get('jobs') or multiprocessing.cpu_count())
+        use_cache = kwargs.get('cache', 'no-cache' not in opts)
+        cache = ResultCache(sys.argv[0]) if use_cache else None
+        plan = _select(classes, cache, opts)
+        tasks = [ (class_, name) for (class_, names) in plan for name in names ]
+        keys = [ cache.key(class_, name) for (class_, name) in tasks ] if cache else [None] * len(tasks)
+        cached = [ cache.get(class_, name, key) if cache else None for ((class_, name), key) in zip(tasks, keys) ]
+        pending = [ task for (task, outcome) in zip(tasks, cached) if outcome is None ]
+        _baselines.clear()
+        if opts.get('bench-baseline'):
+            with open(opts['bench-baseline']) as f:
+                _baselines.update(json.load(f))
+        results = _run(pending, workers)
+        outcomes = itertools.izip(keys, cached, (outcome or next(results) for outcome in cached))
+        tests_ok, tests_fail, tests_ran, failed, timings = 0, 0, 0, [], []
+        for class_, names in plan:
             print color(color.FG_BROWN, color.BOLD) + class_.__name__ + color(color.DEFAULT)
-            ok, fail, ran = class_().run()
+            ok, fail, ran = 0, 0, len(names)
+            for name, (key, was_cached, outcome) in itertools.izip(names, outcomes):
+                passed, result, elapsed, ops_per_sec = outcome
+                print test_line(name, passed, result)
+                ok += passed
+                fail += not passed
+                if cache and not was_cached:
+                    cache.put(class_, name, key, outcome)
+                timings.append(dict(test=class_.__name__ + '.' + name, passed=passed, seconds=elapsed, cached=bool(was_cached)))
+                if ops_per_sec is not None:
+                    timings[-1]['ops_per_sec'] = ops_per_sec
             print '{5}{0}{4} -- {6}ok: {1}/{3}; failed: {2}/{3}{4}'.format(
                 class_.__name__,
                 ok, fail, ran,
@@ -81,23 +394,160 @@ class BaseTest(object):
             tests_fail,
             tests_ran,
             ', '.join(failed))
+        if cache:
+            cache.save()
+            if len(pending) < len(tasks):
+                print 'cached: {0}/{1}'.format(len(tasks) - len(pending), len(tasks))
+        BaseTest.report_timings(timings, kwargs.get('slowest'), kwargs.get('save'))
+        if opts.get('bench-save'):
+            with open(opts['bench-save'], 'w') as f:
+                json.dump(dict((timing['test'], timing['ops_per_sec']) for timing in timings if 'ops_per_sec' in timing),
+                    f, indent=2, sort_keys=True)
+
+    @staticmethod
+    def report_timings(timings, slowest=None, save=None):
+        '''Print the slowest tests and optionally write all timings as JSON to save; both default to the --slowest=N and --timings=FILE options'''
+        opts = options()
+        slowest = int(opts.get('slowest') or 5) if slowest is None else slowest
+        save = opts.get('timings') if save is None else save
+        ran = [ timing for timing in timings if not timing.get('cached') ]
+        if slowest and ran:
+            print
+            print 'slowest {0} tests:'.format(min(slowest, len(ran)))
+            for timing in sorted(ran, key=lambda timing: -timing['seconds'])[:slowest]:
+                print '  {0:10.6f}s {1}'.format(timing['seconds'], timing['test'])
+        if save:
+            with open(save, 'w') as f:
+                json.dump(timings, f, indent=2, sort_keys=True)
+
+    @classmethod
+    def test_names(cls, pattern=None):
+        '''-> sorted names of the tests of this class, or those matching a comma-separated list of patterns like euler_00? or TestSets.*'''
+        names = sorted(cls._tests)
+        if pattern:
+            patterns = pattern.split(',')
+            names = [ name for name in names
+                if any(fnmatch.fnmatchcase(name, p) or fnmatch.fnmatchcase(cls.__name__ + '.' + name, p) for p in patterns) ]
+        return names
+
+    def run_test(self, method):
+        '''method -> (passed, repr of result or exception, elapsed seconds, ops/sec of a benchmark or None), failing
+        with TestTimeout past the method's or class's timeout'''
+        timeout = getattr(method, 'timeout', None) or self.timeout
+        if timeout:
+            handler = signal.signal(signal.SIGALRM, _timed_out)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        start = timeit.default_timer()
+        ops_per_sec = None
+        try:
+            result, passed = method(), True
+            if isinstance(result, Benchmark):
+                ops_per_sec = result.ops_per_sec
+                baseline = _baselines.get(type(self).__name__ + '.' + method.__name__)
+                if baseline:
+                    result.compare(baseline, float(options().get('bench-threshold') or method.threshold))
+        except Exception as ex:
+            result, passed = ex, False
+        finally:
+            elapsed = timeit.default_timer() - start
+            if timeout:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, handler)
+        return passed, repr(result), elapsed, ops_per_sec
 
     def run(self):
-        methods = [ getattr(self, name)
-            for name in sorted(dir(self))
-            if callable(getattr(self, name)) 
-            if hasattr(getattr(self, name), 'is_test') ]
         tests_ok = 0
         tests_fail = 0
-        tests_total = len(methods)
-        for method in methods:
+        names = self.test_names()
+        for name in names:
+            passed, result, elapsed, ops_per_sec = self.run_test(getattr(self, name))
+            print test_line(name, passed, result)
+            tests_ok += passed
+            tests_fail += not passed
+        return tests_ok, tests_fail, len(names)
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    class Test(BaseTest):
+        pass
+
+    class Sample(BaseTest):
+        @returns(1)
+        def a(self):
+            return 1
+        @returns(2)
+        def b(self):
+            return 2
+
+    class Other(BaseTest):
+        @returns(3)
+        def c(self):
+            return 3
+
+    class Dying(BaseTest):
+        def exits(self):
+            os._exit(3)
+        def quits(self):
+            sys.exit(4)
+
+    class TestWorkers(Test):
+        @returns([(True, '1'), (False, "RuntimeError('Test worker exited with code 3',)"), (True, '2'),
+            (False, "RuntimeError('Test worker exited with code 4',)"), (True, '3')])
+        def worker_exits(self):
+            saved = _tasks[:], dict(_instances)
             try:
-                result = method()
-                print '  ' + color(color.FG_GREEN, color.BOLD) + method.__name__ + color(color.DEFAULT) \
-                    + ' ' + repr(result)
-                tests_ok += 1
-            except Exception as ex:
-                print '  ' + color(color.FG_RED, color.BOLD) + method.__name__ + color(color.DEFAULT) \
-                    + ' ' + repr(ex)
-                tests_fail += 1
-        return tests_ok, tests_fail, tests_total            
+                tasks = [(Sample, 'a'), (Dying, 'exits'), (Sample, 'b'), (Dying, 'quits'), (Other, 'c')]
+                return [ outcome[:2] for outcome in _run_parallel(tasks, 2) ]
+            finally:
+                _tasks[:] = saved[0]
+                _instances.clear()
+                _instances.update(saved[1])
+
+    class TestResultCache(Test):
+        def __init__(self):
+            self.directory = tempfile.mkdtemp()
+            self.script = os.path.join(self.directory, 'script.py')
+            os.mkdir(os.path.join(self.directory, 'package'))
+            self.write('script.py', 'pass\n')
+            self.write('package/helper.py', 'def f(): return 1\n')
+        def __del__(self):
+            shutil.rmtree(self.directory, ignore_errors=True)
+        def write(self, name, text):
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write(text)
+        def cache(self, passed=(True, True, True)):
+            cache = ResultCache(self.script)
+            for ((class_, name), ok) in zip([(Sample, 'a'), (Sample, 'b'), (Other, 'c')], passed):
+                cache.put(class_, name, cache.key(class_, name), (ok, 'x', 0.0, None))
+            cache.save()
+            return ResultCache(self.script)
+        @returns((True, None))
+        def unchanged(self):
+            cache = self.cache()
+            return cache.get(Sample, 'a', cache.key(Sample, 'a')) is not None, \
+                cache.get(Sample, 'b', 'other key')
+        @returns(None)
+        def invalidated_by_subpackage(self):
+            self.cache()
+            self.write('package/helper.py', 'def f(): return 2\n')
+            cache = ResultCache(self.script)
+            return cache.get(Sample, 'a', cache.key(Sample, 'a'))
+        @returns(None)
+        def failed_reruns(self):
+            cache = self.cache((False, True, True))
+            return cache.get(Sample, 'a', cache.key(Sample, 'a'))
+        @returns([(Sample, ['b'])])
+        def last_failed(self):
+            return _select([Sample, Other], self.cache((True, False, True)), {'last-failed': ''})
+        @returns([(Sample, ['a', 'b']), (Other, ['c'])])
+        def last_failed_none(self):
+            return _select([Sample, Other], self.cache(), {'last-failed': ''})
+        @returns(([(Other, ['c']), (Sample, ['a', 'b'])], [(Sample, ['b', 'a']), (Other, ['c'])]))
+        def failed_first(self):
+            return _select([Sample, Other], self.cache((True, True, False)), {'failed-first': ''}), \
+                _select([Sample, Other], self.cache((True, False, True)), {'failed-first': ''})
+
+    color.ENABLED = sys.stdout.isatty()
+    BaseTest.run_all_tests(base_class=Test, g=globals(), cache=False)
@@ -1,127 +1,928 @@
 #!/usr/bin/python
 
+import collections
+import cPickle
+import heapq
 import itertools
+import math
+import multiprocessing
+import operator
+import tempfile
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+###############################################################################
+
+# A Query records restriction/projection/partitioning operators as a plan of
+# (op, args) tuples on top of its source. When the query is iterated the plan
+# is compiled into a single generator function with one loop, so a chain like
+# where().select().take_while() costs one frame switch per item, not three.
+
+PLAN_OPS = ('where', 'select', 'select_many', 'take', 'skip', 'take_while', 'skip_while')
+PLAN_SEGMENT = 16
+
+_plan_cache = {}
+
+def _plan_source(shape):
+    head, body = [], []
+    def emit(i, var, depth):
+        pad = '    ' * depth
+        if i == len(shape):
+            body.append(pad + 'yield ' + var)
+            return
+        op, a, b, c, x, y = shape[i], 'a%d' % i, 'b%d' % i, 'c%d' % i, 'x%d' % (i + 1), 'y%d' % i
+        if op == 'where':
+            body.append(pad + 'if {0}({1}):'.format(a, var))
+            emit(i + 1, var, depth + 1)
+        elif op == 'select':
+            body.append(pad + '{0} = {1}({2})'.format(x, a, var))
+            emit(i + 1, x, depth)
+        elif op == 'select_many':
+            body.append(pad + 'for {0} in {1}({2}):'.format(y, a, var))
+            body.append(pad + '    {0} = {1}({2}, {3})'.format(x, b, var, y))
+            emit(i + 1, x, depth + 1)
+        elif op == 'take':
+            head.append('    if {0} <= 0: return'.format(a))
+            head.append('    {0} = 0'.format(c))
+            body.append(pad + '{0} += 1'.format(c))
+            emit(i + 1, var, depth)
+            body.append(pad + 'if {0} >= {1}: return'.format(c, a))
+        elif op == 'skip':
+            head.append('    {0} = 0'.format(c))
+            body.append(pad + 'if {0} < {1}:'.format(c, a))
+            body.append(pad + '    {0} += 1'.format(c))
+            body.append(pad + 'else:')
+            emit(i + 1, var, depth + 1)
+        elif op == 'take_while':
+            body.append(pad + 'if not {0}({1}): return'.format(a, var))
+            emit(i + 1, var, depth)
+        elif op == 'skip_while':
+            head.append('    {0} = True'.format(c))
+            body.append(pad + 'if not {0} or not {1}({2}):'.format(c, a, var))
+            body.append(pad + '    {0} = False'.format(c))
+            emit(i + 1, var, depth + 1)
+        else:
+            raise ValueError('Unknown plan operator: {0}'.format(op))
+    emit(0, 'x0', 2)
+    params = ', '.join(['src'] + ['a%d, b%d' % (i, i) for i in range(len(shape))])
+    return '\n'.join(['def fused({0}):'.format(params)] + head + ['    for x0 in src:'] + body) + '\n'
+
+def compile_plan(plan):
+    '''plan -> function that takes an iterable and runs every stage of plan over it in one generator'''
+    if len(plan) > PLAN_SEGMENT:
+        first, rest = compile_plan(plan[:PLAN_SEGMENT]), compile_plan(plan[PLAN_SEGMENT:])
+        return lambda iterable: rest(first(iterable))
+    shape = tuple(op for (op, args) in plan)
+    try:
+        fused = _plan_cache[shape]
+    except KeyError:
+        namespace = {}
+        exec _plan_source(shape) in namespace
+        fused = _plan_cache[shape] = namespace['fused']
+    args = sum(((args + (None, None))[:2] for (op, args) in plan), ())
+    return lambda iterable: fused(iterable, *args)
+
+###############################################################################
+
+# Query.as_parallel() runs the stateless head of a plan (where/select/select_many)
+# over chunks of the source in a multiprocessing pool. Plans and reducers are
+# usually lambdas, which don't pickle, so they are registered in _parallel_tasks
+# before the pool is created and reach the workers by fork; only the chunks and
+# the results travel through pickle.
+
+PARALLEL_OPS = ('where', 'select', 'select_many')
+
+_parallel_tasks = {}
+_parallel_ids = itertools.count()
+
+def _parallel_run((task_id, chunk)):
+    plan, reduce = _parallel_tasks[task_id]
+    items = compile_plan(plan)(chunk) if plan else iter(chunk)
+    return reduce(items) if reduce else list(items)
+
+def _chunks(items, size):
+    i = iter(items)
+    while True:
+        chunk = list(itertools.islice(i, size))
+        if not chunk:
+            break
+        yield chunk
+
+def split_plan(plan):
+    '''plan -> (head that can run in parallel, rest that must run on the merged stream)'''
+    for (i, (op, args)) in enumerate(plan):
+        if op not in PARALLEL_OPS:
+            return plan[:i], plan[i:]
+    return plan, ()
+
+class Query_Parallel(object):
+    def __init__(self, source, workers=None, chunk_size=1024, ordered=True):
+        self.source = source
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+    def __iter__(self):
+        return iter(self.source)
+    def chunks(self):
+        return _chunks(self.source, self.chunk_size)
+    def map(self, plan, reduce=None):
+        task_id = next(_parallel_ids)
+        _parallel_tasks[task_id] = (plan, reduce)
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            imap = pool.imap if self.ordered else pool.imap_unordered
+            for result in imap(_parallel_run, ((task_id, chunk) for chunk in self.chunks())):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+            del _parallel_tasks[task_id]
+    def run(self, plan):
+        head, rest = split_plan(plan)
+        items = itertools.chain.from_iterable(self.map(head)) if head else iter(self.source)
+        return compile_plan(rest)(items) if rest else items
+
+def _chunk_count(items):
+    count = 0
+    for item in items:
+        count += 1
+    return count
+
+def _chunk_fold(func):
+    def fold(items):
+        i = iter(items)
+        try:
+            result = i.next()
+        except StopIteration:
+            return (False, None)
+        for item in i:
+            result = func(result, item)
+        return (True, result)
+    return fold
+
+###############################################################################
+
+# Query.from_array() runs the leading where/select stages of a plan over chunks
+# of a NumPy array: each function is called once per chunk with the whole chunk.
+# A function that raises or doesn't return an array of the right shape (and
+# bool dtype, for where) is remembered and evaluated per element from then on.
+# Items leave the backend as Python scalars. Integer arithmetic happens in int64,
+# which wraps around silently, so a function over an integer chunk is checked
+# against the same function over the chunk as floats: if the two disagree, it
+# runs per element instead. Sums of integer chunks that could leave int64 are
+# added up as Python ints. Only xranges and sequences that make a 1-d array of
+# bool, int or float are cut into chunks, an xrange chunk by chunk as they are
+# needed; any other source, and any source without numpy, runs on the
+# per-element path.
+
+ARRAY_OPS = ('where', 'select')
+ARRAY_REDUCERS = { operator.add: 'sum', min: 'min', max: 'max' }
+
+def _array_source(source):
+    '''source -> xrange or numeric 1-d ndarray to cut chunks from, or None if it has to run per element'''
+    if not numpy:
+        return None
+    if isinstance(source, xrange):
+        return source
+    if not isinstance(source, (list, tuple, numpy.ndarray)):
+        return None
+    array = numpy.asarray(source)
+    return array if array.ndim == 1 and array.dtype.kind in 'biuf' else None
+
+def _array_result(result, chunk, kinds):
+    return isinstance(result, numpy.ndarray) and result.shape == chunk.shape and result.dtype.kind in kinds
+
+def _wraps_around(func, chunk, result):
+    '''Whether func(chunk) may differ from func applied to each of the integers in chunk'''
+    if chunk.dtype.kind not in 'iu':
+        return False
+    try:
+        with numpy.errstate(all='ignore'):
+            check = func(chunk.astype(numpy.float64))
+    except Exception:
+        return True
+    if not _array_result(check, chunk, 'bf' if result.dtype.kind == 'b' else 'biuf'):
+        return True
+    if result.dtype.kind == 'b':
+        return not numpy.array_equal(check, result)
+    return not numpy.allclose(check, result, rtol=1e-9, atol=0)
+
+def _array_sum(out):
+    if out.dtype.kind in 'iu' and numpy.abs(out.astype(numpy.float64)).sum() >= 2.0 ** 62:
+        return sum(out.tolist())
+    return out.sum().item()
+
+class Query_Array(object):
+    def __init__(self, source, chunk_size=65536):
+        self.source = source
+        self.array = _array_source(source)
+        self.chunk_size = chunk_size
+        self.scalar_funcs = set()
+    def __iter__(self):
+        if numpy and isinstance(self.source, numpy.ndarray):
+            return iter(self.source.tolist())
+        return iter(self.source)
+    def chunks(self):
+        array, size = self.array, self.chunk_size
+        if isinstance(array, xrange):
+            step = array[1] - array[0] if len(array) > 1 else 1
+            for i in xrange(0, len(array), size):
+                count = min(size, len(array) - i)
+                yield numpy.arange(array[i], array[i] + count * step, step, dtype=numpy.int64)
+        else:
+            for i in xrange(0, len(array), size):
+                yield array[i:i+size]
+    def apply(self, plan, chunk):
+        '''chunk -> ndarray with every stage of plan applied, or a list if some stage had to run per element'''
+        for (i, (op, args)) in enumerate(plan):
+            func = args[0]
+            if func not in self.scalar_funcs:
+                try:
+                    with numpy.errstate(over='raise'):
+                        result = func(chunk)
+                except Exception:
+                    result = None
+                if op == 'where' and _array_result(result, chunk, 'b') and not _wraps_around(func, chunk, result):
+                    chunk = chunk[result]
+                    continue
+                if op == 'select' and _array_result(result, chunk, 'biuf') and not _wraps_around(func, chunk, result):
+                    chunk = result
+                    continue
+                self.scalar_funcs.add(func)
+            return list(compile_plan(plan[i:])(chunk.tolist()))
+        return chunk
+    def run(self, plan):
+        if self.array is None:
+            return compile_plan(plan)(iter(self))
+        head, rest = self.split(plan)
+        items = itertools.chain.from_iterable(
+            (out.tolist() if isinstance(out, numpy.ndarray) else out)
+            for out in (self.apply(head, chunk) for chunk in self.chunks()))
+        return compile_plan(rest)(items) if rest else items
+    def split(self, plan):
+        for (i, (op, args)) in enumerate(plan):
+            if op not in ARRAY_OPS:
+                return plan[:i], plan[i:]
+        return plan, ()
+    def fold(self, plan, func):
+        if self.array is None or func not in ARRAY_REDUCERS or self.split(plan)[1]:
+            return None
+        return self.fold_gen(plan, func)
+    def fold_gen(self, plan, func):
+        for chunk in self.chunks():
+            out = self.apply(plan, chunk)
+            if not isinstance(out, numpy.ndarray):
+                yield _chunk_fold(func)(out)
+            elif len(out) and func is operator.add:
+                yield (True, _array_sum(out))
+            elif len(out):
+                yield (True, getattr(out, ARRAY_REDUCERS[func])().item())
+    def count(self, plan):
+        if self.array is None or self.split(plan)[1]:
+            return None
+        return (len(self.apply(plan, chunk)) for chunk in self.chunks())
+
+###############################################################################
+
+# Query.with_memory_budget(n) lets order_by, reversed, group_by and distinct hold
+# at most about n items in memory. Past that they write sorted runs or hash
+# partitions of pickled items to temporary files and stream them back. Sorted
+# runs are merged MERGE_FAN_IN at a time as they are written, so the number of
+# open files stays bounded; a hash partition holding more than n items is
+# partitioned again on the next digits of its keys' hashes, up to SPILL_LEVELS
+# deep. The budget lives on a generated subclass of the query's class, so it
+# carries over to every query built from it through self.__class__.
+
+SPILL_PARTITIONS = 16
+SPILL_LEVELS = 6
+MERGE_FAN_IN = 32
+
+_budget_classes = {}
+
+def _budget_class(cls, budget):
+    try:
+        return _budget_classes[cls, budget]
+    except KeyError:
+        base = cls.__bases__[0] if cls.memory_budget is not None else cls
+        result = _budget_classes[cls, budget] = type(base.__name__, (base,), { 'memory_budget': budget })
+        return result
+
+class Spill(object):
+    '''Temporary file of pickled items, written once and then read back in order or by offset'''
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.count = 0
+    def write(self, item):
+        self.file.seek(0, 2)
+        offset = self.file.tell()
+        cPickle.dump(item, self.file, cPickle.HIGHEST_PROTOCOL)
+        self.count += 1
+        return offset
+    def load_at(self, offset):
+        self.file.flush()
+        self.file.seek(offset)
+        return cPickle.load(self.file)
+    def extend(self, items):
+        for item in items:
+            self.write(item)
+    def __iter__(self):
+        self.file.flush()
+        self.file.seek(0)
+        for _ in xrange(self.count):
+            yield cPickle.load(self.file)
+    def close(self):
+        self.file.close()
+
+def _spill_partitions(items, key_selector, level=0):
+    partitions = [Spill() for _ in xrange(SPILL_PARTITIONS)]
+    for item in items:
+        partitions[_hash64(key_selector(item)) // SPILL_PARTITIONS ** level % SPILL_PARTITIONS].write(item)
+    return partitions
+
+def _bounded_partitions(items, key_selector, budget, level=0):
+    '''items -> Spills holding the items, equal keys together, each with at most budget items unless SPILL_LEVELS runs out'''
+    partitions = _spill_partitions(items, key_selector, level)
+    try:
+        for partition in partitions:
+            if partition.count > budget and level + 1 < SPILL_LEVELS:
+                for sub in _bounded_partitions(partition, key_selector, budget, level + 1):
+                    yield sub
+            else:
+                yield partition
+            partition.close()
+    finally:
+        for partition in partitions:
+            partition.close()
+
+def external_sorted(items, key, reverse, budget):
+    '''sorted(items, key=key, reverse=reverse) holding at most budget items in memory'''
+    chunks = _chunks(items, budget)
+    first, second = next(chunks, []), next(chunks, None)
+    if second is None:
+        return iter(sorted(first, key=key, reverse=reverse))
+    return _merge_runs(itertools.chain([first, second], chunks), key or (lambda item: item), reverse)
+
+def _merge_runs(chunks, key, reverse):
+    levels = []
+    try:
+        for (run_no, chunk) in enumerate(chunks):
+            entries = [(Descending(key(item)) if reverse else key(item), run_no, n, item)
+                for (n, item) in enumerate(chunk)]
+            entries.sort()
+            run = Spill()
+            run.extend(entries)
+            _add_run(levels, 0, run)
+        for entry in heapq.merge(*[run for runs in levels for run in runs]):
+            yield entry[-1]
+    finally:
+        for runs in levels:
+            for run in runs:
+                run.close()
+
+def _add_run(levels, level, run):
+    if level == len(levels):
+        levels.append([])
+    levels[level].append(run)
+    if len(levels[level]) >= MERGE_FAN_IN:
+        merged = Spill()
+        merged.extend(heapq.merge(*levels[level]))
+        for run in levels[level]:
+            run.close()
+        levels[level] = []
+        _add_run(levels, level + 1, merged)
+
+def external_reversed(items, budget):
+    chunks = _chunks(items, budget)
+    first, second = next(chunks, []), next(chunks, None)
+    if second is None:
+        return reversed(first)
+    return _reversed_runs(itertools.chain([first, second], chunks))
+
+def _reversed_runs(chunks):
+    runs = Spill()
+    try:
+        offsets = [runs.write(chunk) for chunk in chunks]
+        for offset in reversed(offsets):
+            for item in reversed(runs.load_at(offset)):
+                yield item
+    finally:
+        runs.close()
+
+def external_group(pairs, budget):
+    '''(key, value) pairs -> iterator over (key, [value, ...]) holding at most budget values in memory'''
+    result = {}
+    i = iter(pairs)
+    count = 0
+    for (k, v) in i:
+        try:
+            result[k].append(v)
+        except KeyError:
+            result[k] = [v]
+        count += 1
+        if count >= budget:
+            break
+    else:
+        return result.iteritems()
+    held = ((k, v) for (k, vs) in result.iteritems() for v in vs)
+    return _grouped_partitions(_bounded_partitions(itertools.chain(held, i), lambda (k, v): k, budget))
+
+def _grouped_partitions(partitions):
+    for partition in partitions:
+        result = {}
+        for (k, v) in partition:
+            try:
+                result[k].append(v)
+            except KeyError:
+                result[k] = [v]
+        for item in result.iteritems():
+            yield item
+
+def _distinct_partitions(seen, rest, budget, key_selector=None):
+    key_selector = key_selector or (lambda item: item)
+    yielded = ((-1, k, None) for k in seen)
+    entries = ((n, key_selector(item), item) for (n, item) in enumerate(rest))
+    first = Spill()
+    try:
+        for partition in _bounded_partitions(itertools.chain(yielded, entries), lambda (n, k, item): k, budget):
+            unique = set()
+            for (n, k, item) in partition:
+                if k not in unique:
+                    unique.add(k)
+                    if n >= 0:
+                        first.write((n, item))
+        for (n, item) in external_sorted(first, None, False, budget):
+            yield item
+    finally:
+        first.close()
+
+###############################################################################
+
+# Set operators keep one set of keys and update it in place, with the bound
+# add/remove looked up once. Items are kept while their key is not yet in the
+# set (distinct, union, difference), or while it still is, removing it as they
+# go (intersect), which also ends the scan early once the set runs empty. The
+# source is iterated once, so projections in its plan run once per item.
+
+def _unseen(items, seen, key_selector=None):
+    add = seen.add
+    if key_selector is None:
+        for item in items:
+            if item not in seen:
+                add(item)
+                yield item
+    else:
+        for item in items:
+            k = key_selector(item)
+            if k not in seen:
+                add(k)
+                yield item
+
+def _take_once(items, keep, key_selector=None):
+    remove = keep.remove
+    for item in items:
+        if not keep:
+            return
+        k = item if key_selector is None else key_selector(item)
+        if k in keep:
+            remove(k)
+            yield item
+
+def _key_set(items, key_selector=None):
+    return set(items) if key_selector is None else set(itertools.imap(key_selector, items))
+
+# Approximate membership and cardinality for streams too large to keep a set of:
+# a Bloom filter answers "seen before?" with no false negatives and a tunable
+# rate of false positives, and HyperLogLog estimates the number of distinct
+# items in 2 ** precision bytes with a standard error of about 1.04 / sqrt(2 **
+# precision). Both hash items with hash() spread over 64 bits by the splitmix64
+# finalizer, since hash() of small ints is the int itself.
+
+MASK64 = (1 << 64) - 1
+
+def _hash64(item):
+    h = hash(item) & MASK64
+    h = (h ^ (h >> 30)) * 0xbf58476d1ce4e5b9 & MASK64
+    h = (h ^ (h >> 27)) * 0x94d049bb133111eb & MASK64
+    return h ^ (h >> 31)
+
+class BloomFilter(object):
+    '''Set of items that may claim to contain an item it was never given, at a rate of error_rate when filled to capacity'''
+    def __init__(self, capacity, error_rate=0.01):
+        if capacity < 1 or not 0 < error_rate < 1:
+            raise ValueError('Invalid Bloom filter capacity {0} or error rate {1}'.format(capacity, error_rate))
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(float(self.size) / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+    def _positions(self, item):
+        h = _hash64(item)
+        h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        return [(h1 + i * h2) % self.size for i in xrange(self.hashes)]
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+    def add(self, item):
+        '''item -> whether item was (probably) present already'''
+        bits, present = self.bits, True
+        for p in self._positions(item):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                present = False
+        return present
+
+class HyperLogLog(object):
+    '''Estimator of the number of distinct items added'''
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 16:
+            raise ValueError('HyperLogLog precision must be between 4 and 16, not {0}'.format(precision))
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+    def add(self, item):
+        h, width = _hash64(item), 64 - self.precision
+        index, rank = h >> width, width - (h & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    def update(self, items):
+        for item in items:
+            self.add(item)
+    def count(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        if estimate <= 2.5 * m:
+            zeros = self.registers.count('\x00')
+            if zeros:
+                estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+###############################################################################
 
 class Query_Base(object):
-    def __init__(self, iterable):
+    memory_budget = None
+    def __init__(self, iterable, plan=()):
         self.iterable = iterable
+        self.plan = plan
     def __iter__(self):
-        return iter(self.iterable)    
+        if self.plan and isinstance(self.iterable, (Query_Parallel, Query_Array)):
+            return self.iterable.run(self.plan)
+        if self.plan:
+            return compile_plan(self.plan)(self.iterable)
+        return iter(self.iterable)
+    def _extend(self, op, *args):
+        return self.__class__(self.iterable, self.plan + ((op, args),))
+    def _partials(self, reduce):
+        if isinstance(self.iterable, Query_Parallel) and not split_plan(self.plan)[1]:
+            return self.iterable.map(self.plan, reduce)
+    def _fold_partials(self, func):
+        if isinstance(self.iterable, Query_Array):
+            partials = self.iterable.fold(self.plan, func)
+        else:
+            partials = self._partials(_chunk_fold(func))
+        if partials is not None:
+            return _chunk_fold(func)(result for (non_empty, result) in partials if non_empty)
+    def _sequence(self):
+        if not isinstance(self.iterable, RANDOM_ACCESS):
+            return None
+        if not all(op in SEQUENCE_OPS for (op, args) in self.plan):
+            return None
+        sequence = Query_Sequence.of(self.iterable)
+        for (op, args) in self.plan:
+            sequence = getattr(sequence, op)(*args)
+        return sequence
+    def with_memory_budget(self, items):
+        return _budget_class(self.__class__, items)(self.iterable, self.plan)
+    def as_parallel(self, workers=None, chunk_size=1024, ordered=True):
+        return self.__class__(Query_Parallel(self, workers, chunk_size, ordered))
     
 class Query_Restriction(Query_Base):
     def where(self, pred):
-        return self.__class__(item for item in self if pred(item))
+        return self._extend('where', pred)
     def of_type(self, type_):
         return self.where(lambda item: type(item) == type_)        
 
 class Query_Projection(Query_Base):
     def select(self, func):
-        return self.__class__(func(item) for item in self)
+        return self._extend('select', func)
     def select_many(self, seq_selector=None, res_selector=None):
         seq_selector = seq_selector or (lambda i: i)
         res_selector = res_selector or (lambda ss,i: (ss,i))
-        def select_many_gen():
-            for sub_seq in self:
-                for item in seq_selector(sub_seq):
-                    yield res_selector(sub_seq, item)
-        return self.__class__(select_many_gen())
+        return self._extend('select_many', seq_selector, res_selector)
 
 class Query_Partitioning(Query_Base):
     def take(self, count):
-        def take_gen(count):
-            i = iter(self)
-            while count:
-                yield i.next()
-                count -= 1
-        return self.__class__(take_gen(count))
+        if not self.plan and isinstance(self.iterable, Query_Ordered):
+            return self.__class__(self.iterable.limited(count))
+        return self._extend('take', count)
     def skip(self, count):
-        def skip_gen(count):
-            i = iter(self)
-            while count:
-                i.next()
-                count -= 1
-            while True:
-                yield i.next()
-        return self.__class__(skip_gen(count))
+        return self._extend('skip', count)
     def take_while(self, pred):
-        def take_while_gen():
-            i = iter(self)
-            while True:
-                item = i.next()
-                if not pred(item):
-                    break
-                yield item
-        return self.__class__(take_while_gen())
+        return self._extend('take_while', pred)
     def skip_while(self, pred):
-        def skip_while_gen():
-            i = iter(self)
-            while True:
-                item = i.next()
-                if not pred(item):
-                    yield item
+        return self._extend('skip_while', pred)
+
+class Query_Deferred(object):
+    def __init__(self, func):
+        self.func = func
+    def __iter__(self):
+        return iter(self.func())
+
+class Query_Memo(object):
+    '''Replayable view of a one-shot source: items are pulled once, on demand, and buffered for every
+    iterator. Past limit items the buffer moves to a Spill file in chunks of limit items.'''
+    def __init__(self, source, limit=None):
+        self.source = source
+        self.limit = limit
+        self.iterator = None
+        self.done = False
+        self.count = 0
+        self.head, self.tail = [], []
+        self.spill, self.offsets = None, []
+        self.lock = threading.Lock()
+    def fill(self, index):
+        '''index -> whether item index is buffered, pulling from the source if needed'''
+        with self.lock:
+            while self.count <= index and not self.done:
+                if self.iterator is None:
+                    self.iterator = iter(self.source)
+                try:
+                    item = self.iterator.next()
+                except StopIteration:
+                    self.done, self.iterator = True, None
                     break
-            while True:
-                yield i.next()
-        return self.__class__(skip_while_gen())
+                if self.limit is None or len(self.head) < self.limit:
+                    self.head.append(item)
+                else:
+                    self.tail.append(item)
+                    if len(self.tail) == self.limit:
+                        self.spill = self.spill or Spill()
+                        self.offsets.append(self.spill.write(self.tail))
+                        self.tail = []
+                self.count += 1
+            return index < self.count
+    def __iter__(self):
+        index, chunk_no, chunk = 0, None, None
+        while self.fill(index):
+            with self.lock:
+                if index < len(self.head):
+                    item = self.head[index]
+                else:
+                    n, i = divmod(index - len(self.head), self.limit)
+                    if n < len(self.offsets):
+                        if n != chunk_no:
+                            chunk_no, chunk = n, self.spill.load_at(self.offsets[n])
+                        item = chunk[i]
+                    else:
+                        item = self.tail[i]
+            yield item
+            index += 1
+
+class Descending(object):
+    __slots__ = ('value',)
+    def __init__(self, value):
+        self.value = value
+    def __lt__(self, other):
+        return other.value < self.value
+    def __eq__(self, other):
+        return self.value == other.value
+    def __ne__(self, other):
+        return self.value != other.value
+
+class Query_Ordered(object):
+    def __init__(self, source, keys, limit=None, budget=None):
+        self.source = source
+        self.keys = keys
+        self.limit = limit
+        self.budget = budget
+    def sort_key(self):
+        selectors = [key_selector or (lambda item: item) for (key_selector, descending) in self.keys]
+        directions = set(descending for (key_selector, descending) in self.keys)
+        reverse = directions == set([True])
+        if len(selectors) == 1:
+            return selectors[0], reverse
+        elif len(directions) == 1:
+            return (lambda item: tuple(selector(item) for selector in selectors)), reverse
+        else:
+            keys = zip(selectors, [descending for (key_selector, descending) in self.keys])
+            return (lambda item: tuple(Descending(selector(item)) if descending else selector(item)
+                for (selector, descending) in keys)), False
+    def __iter__(self):
+        key, reverse = self.sort_key()
+        if self.limit is None and self.budget:
+            return external_sorted(self.source, key, reverse, self.budget)
+        elif self.limit is None:
+            return iter(sorted(self.source, key=key, reverse=reverse))
+        elif self.limit <= 0:
+            return iter([])
+        elif reverse:
+            return iter(heapq.nlargest(self.limit, self.source, key=key))
+        else:
+            return iter(heapq.nsmallest(self.limit, self.source, key=key))
+    def limited(self, count):
+        if self.limit is not None:
+            count = min(count, self.limit)
+        return self.__class__(self.source, self.keys, count, self.budget)
+    def then_by(self, key_selector, descending):
+        if self.limit is not None:
+            raise TypeError('Cannot add a sort key to a limited ordering')
+        return self.__class__(self.source, self.keys + ((key_selector, descending),), budget=self.budget)
+
+class Query_Sequence(object):
+    '''Random-access view of source[start + i * step] for i < count, with select functions applied'''
+    def __init__(self, source, start, count, step=1, funcs=()):
+        self.source = source
+        self.start = start
+        self.count = count
+        self.step = step
+        self.funcs = funcs
+    @classmethod
+    def of(cls, source):
+        return source if isinstance(source, cls) else cls(source, 0, len(source))
+    def __len__(self):
+        return self.count
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('No item with index {0}'.format(index))
+        item = self.source[self.start + index * self.step]
+        for func in self.funcs:
+            item = func(item)
+        return item
+    def __iter__(self):
+        for index in xrange(self.count):
+            item = self.source[self.start + index * self.step]
+            for func in self.funcs:
+                item = func(item)
+            yield item
+    def select(self, func):
+        return self.__class__(self.source, self.start, self.count, self.step, self.funcs + (func,))
+    def skip(self, count):
+        count = max(0, min(count, self.count))
+        return self.__class__(self.source, self.start + count * self.step, self.count - count, self.step, self.funcs)
+    def take(self, count):
+        count = max(0, min(count, self.count))
+        return self.__class__(self.source, self.start, count, self.step, self.funcs)
+    def reversed(self):
+        return self.__class__(self.source, self.start + (self.count - 1) * self.step, self.count, -self.step, self.funcs)
+
+RANDOM_ACCESS = (list, tuple, xrange, basestring, Query_Sequence)
+SEQUENCE_OPS = ('select', 'skip', 'take')
 
 class Query_Ordering(Query_Base):
     def order_by(self, key_selector=None):
-        def order_by_gen():
-            for item in sorted(self, key=key_selector):
-                yield item
-        return self.__class__(order_by_gen())
+        return self.__class__(Query_Ordered(self, ((key_selector, False),), budget=self.memory_budget))
+    def order_by_descending(self, key_selector=None):
+        return self.__class__(Query_Ordered(self, ((key_selector, True),), budget=self.memory_budget))
+    def then_by(self, key_selector=None):
+        return self.__class__(self._ordered().then_by(key_selector, False))
+    def then_by_descending(self, key_selector=None):
+        return self.__class__(self._ordered().then_by(key_selector, True))
+    def _ordered(self):
+        if self.plan or not isinstance(self.iterable, Query_Ordered):
+            raise TypeError('then_by requires an ordered query')
+        return self.iterable
+    def top(self, count, key_selector=None):
+        return self.__class__(Query_Ordered(self, ((key_selector, True),), limit=count))
+    def bottom(self, count, key_selector=None):
+        return self.__class__(Query_Ordered(self, ((key_selector, False),), limit=count))
     def reversed(self):
+        sequence = self._sequence()
+        if sequence is not None:
+            return self.__class__(sequence.reversed())
+        if self.memory_budget:
+            return self.__class__(Query_Deferred(lambda: external_reversed(self, self.memory_budget)))
         return self.__class__(item for item in list(self)[::-1])
 
+class Accumulators(object):
+    '''(seed, step) pairs for Query.aggregate_by: seed(item) starts a group, step(acc, item) folds in the next item'''
+    @staticmethod
+    def count():
+        return (lambda item: 1), (lambda acc, item: acc + 1)
+    @staticmethod
+    def sum(selector=None):
+        selector = selector or (lambda item: item)
+        return selector, (lambda acc, item: acc + selector(item))
+    @staticmethod
+    def min(selector=None):
+        selector = selector or (lambda item: item)
+        return selector, (lambda acc, item: min(acc, selector(item)))
+    @staticmethod
+    def max(selector=None):
+        selector = selector or (lambda item: item)
+        return selector, (lambda acc, item: max(acc, selector(item)))
+    @staticmethod
+    def fold(func, initial=None):
+        return (lambda item: func(initial, item)), func
+
 class Query_Grouping(Query_Base):
     def group_by(self, key_selector=None, val_selector=None):
-        result = {} 
         key_selector = key_selector or (lambda item: item)
         val_selector = val_selector or (lambda item: item)
-        for k, v in self.select(lambda item: (key_selector(item), val_selector(item))):
-            try:
-                result[k].append(v)
-            except KeyError:
-                result[k] = [v]
+        def group(items):
+            result = {}
+            for item in items:
+                k = key_selector(item)
+                try:
+                    result[k].append(val_selector(item))
+                except KeyError:
+                    result[k] = [val_selector(item)]
+            return result
+        partials = self._partials(group)
+        if partials is None and self.memory_budget:
+            pairs = self.select(lambda item: (key_selector(item), val_selector(item)))
+            return self.__class__((k, self.__class__(v)) for (k, v) in external_group(pairs, self.memory_budget))
+        elif partials is None:
+            result = group(self)
+        else:
+            result = {}
+            for partial in partials:
+                for (k, v) in partial.iteritems():
+                    try:
+                        result[k].extend(v)
+                    except KeyError:
+                        result[k] = v
         return self.__class__((k, self.__class__(v)) for (k, v) in result.iteritems())
+    def aggregate_by(self, key_selector=None, *accumulators):
+        key_selector = key_selector or (lambda item: item)
+        accumulators = accumulators or (Accumulators.count(),)
+        def aggregate_by_single_gen():
+            result = {}
+            seed, step = accumulators[0]
+            for item in self:
+                k = key_selector(item)
+                if k in result:
+                    result[k] = step(result[k], item)
+                else:
+                    result[k] = seed(item)
+            return result.iteritems()
+        def aggregate_by_multi_gen():
+            result = {}
+            for item in self:
+                k = key_selector(item)
+                if k in result:
+                    accs = result[k]
+                    for (i, (seed, step)) in enumerate(accumulators):
+                        accs[i] = step(accs[i], item)
+                else:
+                    result[k] = [seed(item) for (seed, step) in accumulators]
+            return ((k, tuple(accs)) for (k, accs) in result.iteritems())
+        if len(accumulators) == 1:
+            return self.__class__(Query_Deferred(aggregate_by_single_gen))
+        else:
+            return self.__class__(Query_Deferred(aggregate_by_multi_gen))
 
 class Query_Sets(Query_Base):
-    def distinct(self):
+    def distinct(self, key_selector=None):
+        budget = self.memory_budget
+        if not budget:
+            return self.__class__(Query_Deferred(lambda: _unseen(self, set(), key_selector)))
         def distinct_gen():
             seen = set()
-            for item in self:
-                if item in seen:
+            add = seen.add
+            i = iter(self)
+            for item in i:
+                k = item if key_selector is None else key_selector(item)
+                if k in seen:
                     continue
-                seen |= set([item])
+                add(k)
+                yield item
+                if len(seen) >= budget:
+                    break
+            else:
+                return
+            for item in _distinct_partitions(seen, i, budget, key_selector):
                 yield item
         return self.__class__(distinct_gen())
-    def union(self, other):
-        def union_gen():
-            seen = set([])
-            for item in self:
-                if item not in seen:
-                    yield item
-                    seen |= set([item])
-            for item in other:
-                if item not in seen:
-                    yield item
-                    seen |= set([item])            
-        return self.__class__(union_gen())
-    def intersect(self, other):
+    def union(self, other, key_selector=None):
+        return self.__class__(itertools.chain(self, other)).distinct(key_selector)
+    def intersect(self, other, key_selector=None):
         def intersect_gen():
-            s2 = set(other)
-            for item in self:
-                if item in s2:
-                    yield item
-        return self.__class__(intersect_gen())
-    def difference(self, other):
+            return _take_once(self, _key_set(other, key_selector), key_selector)
+        return self.__class__(Query_Deferred(intersect_gen))
+    def difference(self, other, key_selector=None):
         def difference_gen():
-            s2 = set(other)
+            return _unseen(self, _key_set(other, key_selector), key_selector)
+        return self.__class__(Query_Deferred(difference_gen))
+    def approximate_distinct(self, capacity, error_rate=0.01, key_selector=None):
+        '''Distinct items in bounded memory; about error_rate of them are wrongly taken for duplicates and dropped'''
+        def approximate_distinct_gen():
+            seen = BloomFilter(capacity, error_rate)
+            add = seen.add
             for item in self:
-                if item in s2:
-                    continue
-                yield item
-        return self.__class__(difference_gen())
+                if not add(item if key_selector is None else key_selector(item)):
+                    yield item
+        return self.__class__(approximate_distinct_gen())
+    def count_distinct(self, key_selector=None, precision=None):
+        '''Number of distinct items (or keys), estimated by HyperLogLog in 2 ** precision bytes if precision is given'''
+        items = self if key_selector is None else itertools.imap(key_selector, self)
+        if precision is None:
+            return len(set(items))
+        counter = HyperLogLog(precision)
+        counter.update(items)
+        return counter.count()
 
 class Query_Conversion(Query_Base):
     def to_list(self):
@@ -143,7 +944,7 @@ class Query_Elements(Query_Base):
         if pred:
             return self.where(pred).first()
         else:
-            i = iter(self)
+            i = iter(self.take(1))
             try:
                 return i.next()
             except StopIteration:
@@ -157,6 +958,11 @@ class Query_Elements(Query_Base):
         if pred:
             return self.where(pred).last()
         else:
+            sequence = self._sequence()
+            if sequence is not None:
+                if not len(sequence):
+                    raise ValueError('Empty sequence')
+                return sequence[-1]
             item = no_item = object()
             for item in self:
                 pass
@@ -199,6 +1005,11 @@ class Query_Elements(Query_Base):
             except StopIteration:
                 return result
     def element_at(self, index):
+        sequence = self._sequence()
+        if sequence is not None:
+            if index < 0:
+                raise IndexError('No item with index {0}'.format(index))
+            return sequence[index]
         for idx, item in enumerate(self):
             if idx == index:
                 return item
@@ -232,8 +1043,15 @@ class Query_Quantifiers(Query_Base):
     def contains(self, value):
         return self.any(lambda item: item == value)
 
+Stats = collections.namedtuple('Stats', 'count sum mean min max variance')
+
 class Query_Aggregates(Query_Base):
-    def aggregate(self, func, initial=None, allow_empty=True):
+    def aggregate(self, func, initial=None, allow_empty=True, combine=None):
+        if combine:
+            partials = self._partials(_chunk_fold(func))
+            if partials is not None:
+                return self.__class__(result for (non_empty, result) in partials if non_empty) \
+                    .aggregate(combine, initial, allow_empty)
         result = initial
         is_empty = True
         for item in self:
@@ -246,55 +1064,260 @@ class Query_Aggregates(Query_Base):
         if selector:
             return self.select(selector).sum()
         else:
-            return self.aggregate(lambda a, b: a + b, initial=0, allow_empty=False)
+            partial = self._fold_partials(operator.add)
+            if partial is not None:
+                non_empty, result = partial
+                if not non_empty:
+                    raise ValueError('Empty sequence')
+                return result
+            i = iter(self)
+            try:
+                first = i.next()
+            except StopIteration:
+                raise ValueError('Empty sequence')
+            if isinstance(first, basestring):
+                return first + first[:0].join(i)
+            return sum(i, first)
     def average(self, selector=None):
         if selector:
             return self.select(selector).average()
         else:
-            i1, i2 = itertools.tee(self)
-            return float(self.__class__(i1).sum()) / self.__class__(i2).count()
+            count, total = 0, 0
+            for item in self:
+                count += 1
+                total += item
+            if not count:
+                raise ValueError('Empty sequence')
+            return float(total) / count
+    def stats(self, selector=None):
+        if selector:
+            return self.select(selector).stats()
+        else:
+            i = iter(self)
+            try:
+                first = i.next()
+            except StopIteration:
+                raise ValueError('Empty sequence')
+            count, total, lowest, highest, mean, m2 = 1, first, first, first, float(first), 0.0
+            for item in i:
+                count += 1
+                total += item
+                if item < lowest:
+                    lowest = item
+                if item > highest:
+                    highest = item
+                delta = item - mean
+                mean += delta / count
+                m2 += delta * (item - mean)
+            return Stats(count, total, mean, lowest, highest, m2 / count)
     def min(self, pred=None):
         if pred:
             return self.where(pred).min()
         else:
-            lowest = self.first()
-            for item in self.skip(1):
-                if item < lowest:
-                    lowest = item
-            return lowest
+            partial = self._fold_partials(min)
+            if partial is not None:
+                non_empty, lowest = partial
+                if not non_empty:
+                    raise ValueError('Empty sequence')
+                return lowest
+            i = iter(self)
+            try:
+                first = i.next()
+            except StopIteration:
+                raise ValueError('Empty sequence')
+            return min(itertools.chain((first,), i))
     def max(self, pred=None):
         if pred:
             return self.where(pred).max()
         else:
-            highest = self.first()
-            for item in self.skip(1):
-                if item > highest:
-                    highest = item
-            return highest
+            partial = self._fold_partials(max)
+            if partial is not None:
+                non_empty, highest = partial
+                if not non_empty:
+                    raise ValueError('Empty sequence')
+                return highest
+            i = iter(self)
+            try:
+                first = i.next()
+            except StopIteration:
+                raise ValueError('Empty sequence')
+            return max(itertools.chain((first,), i))
     def count(self, pred=None):
         if pred:
             return self.where(pred).count()
         else:
+            sequence = self._sequence()
+            if sequence is not None:
+                return len(sequence)
+            if isinstance(self.iterable, Query_Array):
+                partials = self.iterable.count(self.plan)
+            else:
+                partials = self._partials(_chunk_count)
+            if partials is not None:
+                return sum(partials)
             count = 0
             for item in self:
                 count += 1
             return count
 
 class Query_Misc(Query_Base):
-    pass
+    def memoize(self, limit=None):
+        if limit is not None and limit < 1:
+            raise ValueError('Cannot memoize with a limit of {0} items'.format(limit))
+        return self.__class__(Query_Memo(self, limit))
+
+def _check_window(size):
+    if size < 1:
+        raise ValueError('Cannot make windows of {0} items'.format(size))
+
+class Query_Windows(Query_Base):
+    def window(self, size):
+        _check_window(size)
+        def window_gen():
+            window = collections.deque(maxlen=size)
+            for item in self:
+                window.append(item)
+                if len(window) == size:
+                    yield tuple(window)
+        return self.__class__(window_gen())
+    def pairwise(self):
+        def pairwise_gen():
+            i = iter(self)
+            try:
+                prev = i.next()
+            except StopIteration:
+                return
+            for item in i:
+                yield (prev, item)
+                prev = item
+        return self.__class__(pairwise_gen())
+    def rolling_sum(self, size, selector=None):
+        if selector:
+            return self.select(selector).rolling_sum(size)
+        _check_window(size)
+        def rolling_sum_gen():
+            window = collections.deque()
+            total = 0
+            for item in self:
+                window.append(item)
+                total += item
+                if len(window) > size:
+                    total -= window.popleft()
+                if len(window) == size:
+                    yield total
+        return self.__class__(rolling_sum_gen())
+    def rolling_product(self, size, selector=None):
+        if selector:
+            return self.select(selector).rolling_product(size)
+        _check_window(size)
+        def rolling_product_gen():
+            window = collections.deque()
+            product, zeros = 1, 0
+            for item in self:
+                window.append(item)
+                if item:
+                    product *= item
+                else:
+                    zeros += 1
+                if len(window) > size:
+                    leaving = window.popleft()
+                    if leaving:
+                        product /= leaving
+                    else:
+                        zeros -= 1
+                if len(window) == size:
+                    yield 0 if zeros else product
+        return self.__class__(rolling_product_gen())
+    def _rolling_extreme(self, size, better):
+        _check_window(size)
+        def rolling_extreme_gen():
+            window = collections.deque()
+            for (index, item) in enumerate(self):
+                while window and not better(window[-1][1], item):
+                    window.pop()
+                window.append((index, item))
+                if window[0][0] <= index - size:
+                    window.popleft()
+                if index >= size - 1:
+                    yield window[0][1]
+        return self.__class__(rolling_extreme_gen())
+    def rolling_max(self, size, selector=None):
+        if selector:
+            return self.select(selector).rolling_max(size)
+        return self._rolling_extreme(size, operator.gt)
+    def rolling_min(self, size, selector=None):
+        if selector:
+            return self.select(selector).rolling_min(size)
+        return self._rolling_extreme(size, operator.lt)
+
+def _hash_table(items, key_selector):
+    table = {}
+    for item in items:
+        k = key_selector(item)
+        try:
+            table[k].append(item)
+        except KeyError:
+            table[k] = [item]
+    return table
 
 class Query_Joins(Query_Base):
-    def join(self, inner, outer_key, inner_key, result):
-        inner_items = inner \
-            .group_by(inner_key) \
-            .to_dict(lambda (k, g): k, lambda (k, g): g)
-        return Query(self
-            .where(lambda i: outer_key(i) in inner_items)
-            .select_many(lambda i: inner_items[outer_key(i)], result))
-        
+    def join(self, inner, outer_key, inner_key, result=None, build_outer=False):
+        '''Rows in outer order, or in inner order when build_outer hashes the outer side instead of the inner one'''
+        result = result or (lambda a, b: (a, b))
+        def join_outer_gen():
+            table = _hash_table(self, outer_key)
+            for b in inner:
+                for a in table.get(inner_key(b), ()):
+                    yield result(a, b)
+        def join_inner_gen():
+            table = _hash_table(inner, inner_key)
+            for a in self:
+                for b in table.get(outer_key(a), ()):
+                    yield result(a, b)
+        if build_outer:
+            return self.__class__(join_outer_gen())
+        else:
+            return self.__class__(join_inner_gen())
+    def left_join(self, inner, outer_key, inner_key, result=None, default=None):
+        result = result or (lambda a, b: (a, b))
+        def left_join_gen():
+            table = _hash_table(inner, inner_key)
+            for a in self:
+                matches = table.get(outer_key(a))
+                if matches:
+                    for b in matches:
+                        yield result(a, b)
+                else:
+                    yield result(a, default)
+        return self.__class__(left_join_gen())
+    def group_join(self, inner, outer_key, inner_key, result=None):
+        result = result or (lambda a, g: (a, g))
+        def group_join_gen():
+            table = _hash_table(inner, inner_key)
+            for a in self:
+                yield result(a, self.__class__(table.get(outer_key(a), [])))
+        return self.__class__(group_join_gen())
+    def semi_join(self, inner, outer_key, inner_key):
+        def semi_join_gen():
+            keys = set(inner_key(b) for b in inner)
+            for a in self:
+                if outer_key(a) in keys:
+                    yield a
+        return self.__class__(semi_join_gen())
+    def anti_join(self, inner, outer_key, inner_key):
+        def anti_join_gen():
+            keys = set(inner_key(b) for b in inner)
+            for a in self:
+                if outer_key(a) not in keys:
+                    yield a
+        return self.__class__(anti_join_gen())
+
 class Query(Query_Restriction, Query_Projection, Query_Partitioning, Query_Ordering, Query_Grouping, Query_Sets, 
         Query_Conversion, Query_Elements, Query_Generation, Query_Quantifiers, Query_Aggregates, Query_Misc, 
-        Query_Joins):
+        Query_Windows, Query_Joins):
+    @staticmethod
+    def from_array(source, chunk_size=65536):
+        return Query(Query_Array(source, chunk_size))
     @staticmethod
     def repeat(value):
         def repeat_gen():
@@ -328,7 +1351,7 @@ class Query(Query_Restriction, Query_Projection, Query_Partitioning, Query_Order
 Q = Query
 
 if __name__ == '__main__':
-    from jtest import BaseTest, returns, raises
+    from jtest import BaseTest, returns, raises, benchmark
     class Test(BaseTest):
         def __init__(self):
             self.L  = [1,2,3,4,5,6,7,8,9,10]
@@ -392,6 +1415,40 @@ if __name__ == '__main__':
         def skip_while(self):
             return Query(self.L).skip_while(lambda n: n < 8).to_list()
 
+    class TestPlan(Test):
+        @returns([6, 10, 14])
+        def fused_1(self):
+            return Query(self.L) \
+                .where(lambda n: n % 2 == 1) \
+                .select(lambda n: 2 * n) \
+                .skip(1) \
+                .take_while(lambda n: n < 16) \
+                .to_list()
+        @returns([0, 1, 2])
+        def fused_2(self):
+            return Query(itertools.count()) \
+                .where(lambda n: n < 3) \
+                .take(3) \
+                .to_list()
+        @returns(['b', 'r', 'o', 'w', 'n'])
+        def fused_3(self):
+            return Query(self.W2) \
+                .select_many(lambda ws: ws, lambda ws, w: w) \
+                .skip_while(lambda w: w != 'brown') \
+                .take(1) \
+                .select_many(lambda w: w, lambda w, c: c) \
+                .to_list()
+        @returns([21, 22, 23])
+        def fused_4(self):
+            q = Query(self.L)
+            for i in range(20):
+                q = q.select(lambda n: n + 1)
+            return q.take(3).to_list()
+        @returns(([1, 2], [3, 4]))
+        def fused_5(self):
+            q = Query(self.L).where(lambda n: n < 5)
+            return q.take(2).to_list(), q.skip(2).to_list()
+
     class TestOrdering(Test):
         @returns([1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
         def order_by_1(self):
@@ -403,12 +1460,167 @@ if __name__ == '__main__':
             return Query(self.R1) \
                 .order_by(lambda n: n) \
                 .to_list()
-        @returns([])
+        @returns([10, 9, 8, 7, 6, 5, 4, 3, 2, 1])
+        def order_by_descending(self):
+            return Query(self.R1) \
+                .order_by_descending() \
+                .to_list()
+        @returns([(1,4),(1,6),(1,9),(2,1),(2,5),(2,9),(2,10),(3,3),(3,5),(7,3)])
         def then_by_1(self):
             return Query(self.R2) \
                 .order_by(lambda n: n[0]) \
                 .then_by(lambda n: n[1]) \
                 .to_list()
+        @returns([(1,9),(1,6),(1,4),(2,10),(2,9),(2,5),(2,1),(3,5),(3,3),(7,3)])
+        def then_by_2(self):
+            return Query(self.R2) \
+                .order_by(lambda n: n[0]) \
+                .then_by_descending(lambda n: n[1]) \
+                .to_list()
+        @returns([(7,3),(3,3),(3,5)])
+        def then_by_3(self):
+            return Query(self.R2) \
+                .order_by_descending(lambda n: n[0]) \
+                .then_by(lambda n: n[1]) \
+                .take(3) \
+                .to_list()
+        @raises(TypeError)
+        def then_by_4(self):
+            return Query(self.R2) \
+                .then_by(lambda n: n[1])
+
+        @returns([1, 2, 3])
+        def order_by_take(self):
+            return Query(self.R1) \
+                .order_by() \
+                .take(5) \
+                .take(3) \
+                .to_list()
+        @returns((2, 10))
+        def order_by_first(self):
+            return Query(self.R2) \
+                .order_by(lambda n: -n[1]) \
+                .first()
+        @returns([(2, 10), (2, 9), (1, 9)])
+        def top(self):
+            return Query(self.R2) \
+                .top(3, lambda n: n[1]) \
+                .to_list()
+        @returns([(2, 1), (3, 3), (7, 3)])
+        def bottom(self):
+            return Query(self.R2) \
+                .bottom(3, lambda n: n[1]) \
+                .to_list()
+        @returns([])
+        def bottom_empty(self):
+            return Query(self.E) \
+                .bottom(3) \
+                .to_list()
+
+    class TestParallel(Test):
+        @returns([4, 16, 36, 64, 100])
+        def where_select(self):
+            return Query(self.L) \
+                .as_parallel(workers=2, chunk_size=3) \
+                .where(lambda n: n % 2 == 0) \
+                .select(lambda n: n * n) \
+                .to_list()
+        @returns(['The', 'brown', 'fox', 'over', 'the', 'dogs'])
+        def select_many_take(self):
+            return Query(self.W1) \
+                .as_parallel(workers=2, chunk_size=1) \
+                .select_many(lambda s: s.split(' '), lambda s, w: w) \
+                .where(lambda w: 'u' not in w) \
+                .skip_while(lambda w: False) \
+                .where(lambda w: w != 'lazy') \
+                .to_list()
+        @returns([2, 4, 6, 8, 10])
+        def unordered(self):
+            return Query(self.L) \
+                .as_parallel(workers=2, chunk_size=2, ordered=False) \
+                .where(lambda n: n % 2 == 0) \
+                .order_by() \
+                .to_list()
+        @returns((55, 10, 1, 10, 3628800))
+        def aggregates(self):
+            q = Query(self.L).as_parallel(workers=2, chunk_size=3)
+            return q.sum(), q.count(), q.min(), q.max(), q.aggregate(lambda a, b: a * b, 1, combine=lambda a, b: a * b)
+        @returns((10, 290, 0))
+        def aggregate_combine(self):
+            q = Query(range(100)).as_parallel(workers=2, chunk_size=10)
+            return q.where(lambda n: n < 5).aggregate(operator.add, 0, combine=operator.add), \
+                Query(range(20)).as_parallel(workers=2, chunk_size=10).aggregate(operator.add, 100, combine=operator.add), \
+                q.where(lambda n: n < 0).aggregate(operator.add, 0, combine=operator.add)
+        @raises(ValueError)
+        def aggregate_combine_empty(self):
+            return Query(self.L).as_parallel(workers=2, chunk_size=3).where(lambda n: n > 10) \
+                .aggregate(operator.add, 0, allow_empty=False, combine=operator.add)
+        @raises(ValueError)
+        def sum_empty(self):
+            return Query(self.L) \
+                .as_parallel(workers=2, chunk_size=3) \
+                .where(lambda n: n > 10) \
+                .sum()
+        @returns({'b':['blueberry', 'banana'], 'c':['chimpanzee', 'cheese'], 'a':['abacus', 'apple']})
+        def group_by(self):
+            return Query(self.G) \
+                .as_parallel(workers=2, chunk_size=2) \
+                .group_by(lambda s: s[0]) \
+                .select(lambda (key, items): (key, items.to_list())) \
+                .to_dict()
+
+    class TestArray(Test):
+        @returns(233168)
+        def where_sum_1(self):
+            return Query.from_array(xrange(1, 1000), chunk_size=100) \
+                .where(lambda i: (i % 3 == 0) | (i % 5 == 0)) \
+                .sum()
+        @returns(233168)
+        def where_sum_2(self):
+            return Query.from_array(xrange(1, 1000), chunk_size=100) \
+                .where(lambda i: i % 3 == 0 or i % 5 == 0) \
+                .sum()
+        @returns((385, int))
+        def select_sum(self):
+            result = Query.from_array(xrange(1, 11)).select(lambda i: i ** 2).sum()
+            return result, type(result)
+        @returns((5, 2, 10))
+        def count_min_max(self):
+            q = Query.from_array(self.L, chunk_size=3).where(lambda i: i % 2 == 0)
+            return q.count(), q.min(), q.max()
+        @returns(['2', '4', '6', '8'])
+        def fallback(self):
+            return Query.from_array(self.L, chunk_size=4) \
+                .select(lambda i: 2 * i) \
+                .select(str) \
+                .take_while(lambda s: len(s) == 1) \
+                .to_list()
+        @raises(ValueError)
+        def sum_empty(self):
+            return Query.from_array(xrange(0)).sum()
+        @returns((10, 2 ** 70 + 1, [1, 'a'], [[3], [4.5]]))
+        def scalar_sources(self):
+            return Query.from_array(i for i in xrange(5)).sum(), \
+                Query.from_array([2 ** 70, 1]).sum(), \
+                Query.from_array([1, 'a']).to_list(), \
+                Query.from_array([[3], [4.5]]).to_list()
+        @returns((True, [10 ** 12 - 3, 10 ** 12 - 6], 4))
+        def xrange_chunks(self):
+            q = Query.from_array(xrange(10 ** 12, 0, -3), chunk_size=1000)
+            return q.iterable.array is not None and q.iterable.count([]) is not None, \
+                q.skip(1).take(2).to_list(), \
+                Query.from_array(xrange(7, 3, -1), chunk_size=3).count()
+        @returns(True)
+        def select_overflow(self):
+            return Query.from_array(xrange(100000)).select(lambda n: n * n * n * n).sum() \
+                == sum(n ** 4 for n in xrange(100000))
+        @returns(True)
+        def where_overflow(self):
+            return Query.from_array(xrange(100000)).where(lambda n: n * n * n * n > 0).count() == 99999
+        @returns(True)
+        def sum_overflow(self):
+            return Query.from_array(xrange(100000)).select(lambda n: n * 10 ** 13).sum() \
+                == sum(n * 10 ** 13 for n in xrange(100000))
 
     class TestGrouping(Test):
         @returns({'b':['blueberry', 'banana'], 'c':['chimpanzee', 'cheese'], 'a':['abacus', 'apple']})
@@ -417,6 +1629,31 @@ if __name__ == '__main__':
                 .group_by(lambda s: s[0]) \
                 .select(lambda (key, items): (key, items.to_list())) \
                 .to_dict()
+        @returns({'a': 2, 'b': 2, 'c': 2})
+        def aggregate_by_1(self):
+            return Query(self.G) \
+                .aggregate_by(lambda s: s[0]) \
+                .to_dict()
+        @returns({'a': 6, 'b': 9, 'c': 10})
+        def aggregate_by_2(self):
+            return Query(self.G) \
+                .aggregate_by(lambda s: s[0], Accumulators.max(len)) \
+                .to_dict()
+        @returns({1: (3, 19, 4, 9), 2: (4, 25, 1, 10), 3: (2, 8, 3, 5), 7: (1, 3, 3, 3)})
+        def aggregate_by_3(self):
+            return Query(self.R2) \
+                .aggregate_by(lambda (a, b): a,
+                    Accumulators.count(),
+                    Accumulators.sum(lambda (a, b): b),
+                    Accumulators.min(lambda (a, b): b),
+                    Accumulators.max(lambda (a, b): b)) \
+                .to_dict()
+        @returns({'a': 'abacusapple'})
+        def aggregate_by_4(self):
+            return Query(self.G) \
+                .where(lambda s: s[0] == 'a') \
+                .aggregate_by(lambda s: s[0], Accumulators.fold(lambda a, s: a + s, '')) \
+                .to_dict()
 
     class TestSets(Test):
         @returns([2,3,5])
@@ -439,6 +1676,44 @@ if __name__ == '__main__':
             return Query(self.S1) \
                 .difference(Query(self.S2)) \
                 .to_list()
+        @returns(([5,2,8], [0,2,4,6,9]))
+        def deduplicate(self):
+            return Query([5,2,5,8,2,0]).intersect([8,2,5,5]).to_list(), \
+                Query(self.S1 + self.S1).difference(self.S2).to_list()
+        @returns([10, 10, 10])
+        def single_pass(self):
+            def calls(op):
+                counted = []
+                op(Query(range(10)).select(lambda n: counted.append(n) or n % 5)).to_list()
+                return len(counted)
+            return [calls(lambda q: q.distinct()), calls(lambda q: q.difference([7])), calls(lambda q: q.intersect([7]))]
+        @returns(([1,2,3], [2,3,5]))
+        def finite(self):
+            return Query(xrange(1, 4)).distinct().to_list(), \
+                Query((2,2,3,5,5)).select(lambda n: n).distinct().to_list()
+        @returns(([1,12,23], ['a','B'], [10,11], [10,12]))
+        def key_selector(self):
+            return Query([1,11,12,23,3]).distinct(lambda n: n % 10).to_list(), \
+                Query(['a','A','B']).union(['b','c'], lambda s: s.lower()).where(lambda s: s != 'c').to_list(), \
+                Query([10,11,12]).intersect([1,0], lambda n: n % 10).to_list(), \
+                Query([10,11,12]).difference([1], lambda n: n % 10).to_list()
+        @returns([2,3,5,1,0])
+        def union_budget(self):
+            return Query([2,2,3,5]).with_memory_budget(2).union([5,1,0,3]).to_list()
+        @returns([1,11,2])
+        def distinct_budget_key(self):
+            return Query([1,11,21,2,12,22]).with_memory_budget(2).distinct(lambda n: (n > 10, n % 10)).take(3).to_list()
+        @returns((1000, ['a','b','c']))
+        def approximate_distinct(self):
+            return Query(xrange(1000)).concat(xrange(1000)).approximate_distinct(10000, 0.001).count(), \
+                Query('abcABC').approximate_distinct(100, key_selector=str.lower).to_list()
+        @returns((3, True))
+        def count_distinct(self):
+            estimate = Query(xrange(100000)).select(lambda n: n % 50000).count_distinct(precision=12)
+            return Query('abcABC').count_distinct(str.lower), abs(estimate - 50000) < 2500
+        @raises(ValueError)
+        def count_distinct_precision(self):
+            return Query([]).count_distinct(precision=3)
 
     class TestConversion(Test):
         @returns({1:2, 2:4, 3:6, 4:8})
@@ -538,6 +1813,183 @@ if __name__ == '__main__':
         def single_or_default_2d(self):
             return Query(self.L).single_or_default(lambda n: n >= 4, default=42)
 
+    class TestSequence(Test):
+        @returns(10)
+        def count(self):
+            return Query(self.L).select(lambda n: n / 0).count()
+        @returns(3)
+        def count_skip_take(self):
+            return Query(xrange(1000)).skip(995).take(3).count()
+        @returns(18)
+        def last(self):
+            return Query(self.L).select(lambda n: 2 * n).take(9).last()
+        @raises(ValueError)
+        def last_empty(self):
+            return Query(self.L).skip(10).last()
+        @returns('o')
+        def element_at(self):
+            return Query('hello world').skip(1).reversed().element_at(6)
+        @raises(IndexError)
+        def element_at_out_of_range(self):
+            return Query(self.L).take(3).element_at(3)
+        @returns([7, 6, 5])
+        def reversed_skip_take(self):
+            return Query(self.L).reversed().skip(3).take(3).to_list()
+        @returns([])
+        def reversed_empty(self):
+            return Query(self.E).reversed().to_list()
+
+    class TestSpill(Test):
+        def __init__(self):
+            Test.__init__(self)
+            self.N = [(i * 7919) % 1000 for i in xrange(1000)]
+        @returns(True)
+        def order_by(self):
+            return Query(self.N).with_memory_budget(64).order_by().to_list() == sorted(self.N)
+        @returns(True)
+        def order_by_stable(self):
+            return Query(self.N) \
+                .with_memory_budget(64) \
+                .select(lambda n: (n % 10, n)) \
+                .order_by_descending(lambda (a, b): a) \
+                .to_list() == sorted([(n % 10, n) for n in self.N], key=lambda (a, b): a, reverse=True)
+        @returns(True)
+        def then_by(self):
+            return Query(self.N) \
+                .with_memory_budget(64) \
+                .order_by(lambda n: n % 10) \
+                .then_by_descending() \
+                .to_list() == sorted(sorted(self.N, reverse=True), key=lambda n: n % 10)
+        @returns(True)
+        def reversed(self):
+            return Query(iter(self.N)).with_memory_budget(64).reversed().to_list() == self.N[::-1]
+        @returns({0: 100, 1: 100, 9: 100})
+        def group_by(self):
+            return Query(self.N) \
+                .with_memory_budget(64) \
+                .group_by(lambda n: n % 10) \
+                .where(lambda (k, g): k in (0, 1, 9)) \
+                .to_dict(lambda (k, g): k, lambda (k, g): g.count())
+        @returns([0, 7, 4, 1, 8, 5, 2, 9, 6, 3])
+        def distinct(self):
+            return Query(self.N) \
+                .with_memory_budget(4) \
+                .select(lambda n: n * 3 % 10) \
+                .distinct() \
+                .to_list()
+        @returns((True, True))
+        def many_runs(self):
+            import resource
+            N = range(5000)
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(128, hard), hard))
+            try:
+                return Query(N).with_memory_budget(10).order_by(lambda n: -n).to_list() == N[::-1], \
+                    Query(iter(N)).with_memory_budget(10).reversed().to_list() == N[::-1]
+            finally:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        @returns((20000, True))
+        def bounded_partitions(self):
+            counts = [p.count for p in _bounded_partitions(((n, n % 5000) for n in xrange(20000)), lambda (n, k): k, 100)]
+            return sum(counts), max(counts) <= 100
+        @returns((5000, True))
+        def group_by_partitions(self):
+            groups = Query(xrange(20000)).with_memory_budget(100).group_by(lambda n: n % 5000).to_list()
+            return len(groups), all(g.to_list() == range(k, 20000, 5000) for (k, g) in groups)
+        @returns(True)
+        def distinct_partitions(self):
+            return Query(xrange(20000)).with_memory_budget(100).select(lambda n: n * 7 % 3000).distinct().to_list() \
+                == [n * 7 % 3000 for n in xrange(3000)]
+        @returns((64, 'Query'))
+        def budget_carries_over(self):
+            q = Query(self.N).with_memory_budget(32).with_memory_budget(64).where(lambda n: n).select(str)
+            return q.memory_budget, type(q).__name__
+
+    class TestMemoize(Test):
+        def counted(self, items, calls):
+            for item in items:
+                calls.append(item)
+                yield item
+        @returns(([1, 2, 3], [1, 2, 3], [1, 2, 3]))
+        def replay(self):
+            calls = []
+            q = Query(self.counted([1, 2, 3], calls)).memoize()
+            return q.to_list(), q.to_list(), calls
+        @returns(([1, 2], [1, 2, 3, 4], 4))
+        def partial(self):
+            calls = []
+            q = Query(self.counted([1, 2, 3, 4], calls)).memoize()
+            return q.take(2).to_list(), q.to_list(), len(calls)
+        @returns([(1, 1), (2, 2), (3, 3)])
+        def interleaved(self):
+            q = Query(iter([1, 2, 3])).memoize()
+            return q.zip(q).to_list()
+        @returns((True, True, 2))
+        def spill(self):
+            q = Query(iter(xrange(10))).memoize(limit=3)
+            first = q.to_list()
+            return first == range(10), q.to_list() == first, len(q.iterable.offsets)
+        @returns((5.5, 1, 10))
+        def aggregates(self):
+            q = Query(x for x in self.L).memoize()
+            return q.average(), q.min(), q.max()
+        @raises(ValueError)
+        def zero_limit(self):
+            return Query(iter(self.L)).memoize(0)
+        @returns(True)
+        def threads(self):
+            q = Query(iter(xrange(20000))).memoize(limit=7)
+            results = [None] * 4
+            def read(n):
+                results[n] = q.to_list()
+            threads = [threading.Thread(target=read, args=(n,)) for n in xrange(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return all(result == range(20000) for result in results)
+
+    class TestWindows(Test):
+        @returns([(1, 2, 3), (2, 3, 4), (3, 4, 5)])
+        def window(self):
+            return Query(self.L).take(5).window(3).to_list()
+        @returns([])
+        def window_short(self):
+            return Query(self.M).window(4).to_list()
+        @returns([(4, 5), (5, 6)])
+        def pairwise(self):
+            return Query(self.M).pairwise().to_list()
+        @returns([])
+        def pairwise_empty(self):
+            return Query(self.E).pairwise().to_list()
+        @returns([6, 9, 12, 15, 18, 21, 24, 27])
+        def rolling_sum(self):
+            return Query(self.L).rolling_sum(3).to_list()
+        @returns([0, 6, 24, 0, 0, 0, 90, 90])
+        def rolling_product(self):
+            return Query([0, 1, 2, 3, 4, 0, 5, 6, 3, 5]).rolling_product(3).to_list()
+        @returns([10, 10, 8, 9, 9, 9, 4, 7])
+        def rolling_max(self):
+            return Query(self.R1).rolling_max(3).to_list()
+        @returns([5, 2, 2, 2, 4, 1, 1, 1])
+        def rolling_min(self):
+            return Query(self.R1).rolling_min(3).to_list()
+        @raises(ValueError)
+        def window_zero(self):
+            return Query(self.L).window(0)
+        @raises(ValueError)
+        def rolling_sum_zero(self):
+            return Query(self.L).rolling_sum(0, lambda n: n)
+        @raises(ValueError)
+        def rolling_product_negative(self):
+            return Query(self.L).rolling_product(-1)
+        @raises(ValueError)
+        def rolling_max_zero(self):
+            return Query(self.L).rolling_max(0)
+        @raises(ValueError)
+        def rolling_min_zero(self):
+            return Query(self.L).rolling_min(0)
+
     class TestGeneration(Test):
         @returns(None)
         def dummy(self):
@@ -588,6 +2040,9 @@ if __name__ == '__main__':
         @returns(55)
         def sum_1a(self):
             return Query(self.L).sum()
+        @returns(('ab', u'abc', [1, 2]))
+        def sum_concatenates(self):
+            return Query(['a', 'b']).sum(), Query([u'a', 'b', u'c']).sum(), Query([[1], [2]]).sum()
         @raises(ValueError)
         def sum_1b(self):
             return Query(self.E).sum()
@@ -633,6 +2088,21 @@ if __name__ == '__main__':
         @raises(ValueError)
         def max_2b(self):
             return Query(self.E).max(lambda n: n <= 5)
+        @returns((5, 1))
+        def min_max_once(self):
+            return Query(iter([1, 5, 2])).max(), Query(x for x in [5, 1, 2]).min()
+        @returns(3.0)
+        def average_once(self):
+            return Query(iter([1, 5, 3])).average()
+        @returns((10, 55, 5.5, 1, 10, 8.25))
+        def stats_1(self):
+            return tuple(Query(iter(self.L)).stats())
+        @returns((10, 110, 11.0, 2, 20, 33.0))
+        def stats_2(self):
+            return tuple(Query(self.L).stats(lambda n: 2 * n))
+        @raises(ValueError)
+        def stats_3(self):
+            return Query(self.E).stats()
         @returns(5)
         def count_1a(self):
             return Query(self.L).where(lambda n: n <= 5).count()
@@ -654,7 +2124,48 @@ if __name__ == '__main__':
                     Query(['AB', 'BB', 'CB']), 
                     lambda a: a[0], 
                     lambda b: b[0], 
-                    lambda (a,b): (a,b)) \
+                    lambda a, b: (a, b)) \
+                .to_list()
+        @returns(([('BA', 'BB'), ('AA', 'AB'), ('AA', 'AC')], [('BA', 'BB'), ('AA', 'AB'), ('AA', 'AC')]))
+        def join_outer_order(self):
+            inner = ['AB', 'BB', 'AC', 'CB']
+            return Query(['BA', 'AA']).join(inner, lambda a: a[0], lambda b: b[0]).to_list(), \
+                Query(iter(['BA', 'AA'])).join(iter(inner), lambda a: a[0], lambda b: b[0]).to_list()
+        @returns([('AA', 'AB'), ('CA', 'CB'), ('AA', 'AC')])
+        def join_build_outer(self):
+            return Query(['AA', 'CA']) \
+                .join(['AB', 'BB', 'CB', 'AC'], lambda a: a[0], lambda b: b[0], build_outer=True) \
+                .to_list()
+        @returns((3, 4))
+        def join_keys_once(self):
+            calls = [0, 0]
+            def outer_key(a):
+                calls[0] += 1
+                return a[0]
+            def inner_key(b):
+                calls[1] += 1
+                return b[0]
+            Query(['AA', 'BA', 'CA']).join(['AB', 'BB', 'CB', 'AC'], outer_key, inner_key).to_list()
+            return tuple(calls)
+        @returns([('AA', 'AB'), ('AA', 'AC'), ('BA', None), ('CA', 'CB')])
+        def left_join(self):
+            return Query(['AA', 'BA', 'CA']) \
+                .left_join(['AB', 'CB', 'AC'], lambda a: a[0], lambda b: b[0]) \
+                .to_list()
+        @returns([('AA', ['AB', 'AC']), ('BA', []), ('CA', ['CB'])])
+        def group_join(self):
+            return Query(['AA', 'BA', 'CA']) \
+                .group_join(['AB', 'CB', 'AC'], lambda a: a[0], lambda b: b[0], lambda a, g: (a, g.to_list())) \
+                .to_list()
+        @returns(['AA', 'CA'])
+        def semi_join(self):
+            return Query(['AA', 'BA', 'CA']) \
+                .semi_join(['AB', 'CB', 'AC'], lambda a: a[0], lambda b: b[0]) \
+                .to_list()
+        @returns(['BA'])
+        def anti_join(self):
+            return Query(['AA', 'BA', 'CA']) \
+                .anti_join(['AB', 'CB', 'AC'], lambda a: a[0], lambda b: b[0]) \
                 .to_list()
 
     class TestMisc(Test):
@@ -710,6 +2221,17 @@ if __name__ == '__main__':
         def sequence_equal(self):
             return Query(self.L).sequence_equal(self.L)
 
+    class TestBenchmarks(Test):
+        def __init__(self):
+            Test.__init__(self)
+            self.N = range(10000)
+        @benchmark(repeat=5, max_time=0.2)
+        def where_select(self):
+            return Query(self.N).where(lambda n: n % 3).select(lambda n: 2 * n).sum()
+        @benchmark(repeat=5, max_time=0.2)
+        def distinct(self):
+            return Query(self.N).select(lambda n: n % 100).distinct().count()
+
     import sys
     if len(sys.argv) >= 2 and sys.argv[1] == '--mono':
         jtest.color.ENABLED = False
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import math
+
+# Lazy infinite sequences for second-order linear recurrences
+# a(n) = p * a(n - 1) + q * a(n - 2). Iterating walks term by term, but any term
+# (and so skip(n)) is reached in O(log n) multiplications by raising the
+# recurrence's 2x2 matrix to the n'th power; Fibonacci uses fast doubling.
+
+PHI = (1 + math.sqrt(5)) / 2
+
+def mat_mul((a, b, c, d), (e, f, g, h)):
+    return (a * e + b * g, a * f + b * h, c * e + d * g, c * f + d * h)
+
+def mat_pow(m, n):
+    result = (1, 0, 0, 1)
+    while n:
+        if n & 1:
+            result = mat_mul(result, m)
+        m = mat_mul(m, m)
+        n >>= 1
+    return result
+
+def fib_pair(n):
+    'n -> (F(n), F(n + 1)) by fast doubling'
+    if n == 0:
+        return (0, 1)
+    a, b = fib_pair(n >> 1)
+    c = a * (2 * b - a)
+    d = a * a + b * b
+    return (d, c + d) if n & 1 else (c, d)
+
+def fib(n):
+    "n -> n'th Fibonacci number, with fib(0) == 0 and fib(1) == 1"
+    if n < 0:
+        raise ValueError('No Fibonacci number with index {0}'.format(n))
+    return fib_pair(n)[0]
+
+def fib_digits(n):
+    'n -> number of decimal digits of fib(n), estimated from Binet\'s formula without building the number'
+    if n < 7:
+        return 1
+    return int(n * math.log10(PHI) - math.log10(math.sqrt(5))) + 1
+
+def fib_index_with_digits(digits):
+    'digits -> smallest n >= 1 for which fib(n) has at least digits digits'
+    if digits <= 1:
+        return 1
+    n = max(1, int(math.ceil((digits - 1 + math.log10(math.sqrt(5))) / math.log10(PHI))))
+    bound = 10 ** (digits - 1)
+    while n > 1 and fib(n - 1) >= bound:
+        n -= 1
+    while fib(n) < bound:
+        n += 1
+    return n
+
+class Recurrence(object):
+    def __init__(self, p, q, a0, a1, start=0):
+        self.p, self.q, self.a0, self.a1 = p, q, a0, a1
+        self.start = start
+    def term(self, n):
+        "n -> n'th term of the recurrence, counted from a0"
+        if n == 0:
+            return self.a0
+        m = mat_pow((self.p, self.q, 1, 0), n - 1)
+        return m[0] * self.a1 + m[1] * self.a0
+    def __getitem__(self, index):
+        if index < 0:
+            raise IndexError('No item with index {0}'.format(index))
+        return self.term(self.start + index)
+    def __iter__(self):
+        a, b = self.term(self.start), self.term(self.start + 1)
+        while True:
+            yield a
+            a, b = b, self.p * b + self.q * a
+    def skip(self, count):
+        return Recurrence(self.p, self.q, self.a0, self.a1, self.start + count)
+
+class Fibonacci(Recurrence):
+    '''F(start), F(start + 1), ...'''
+    def __init__(self, start=0):
+        Recurrence.__init__(self, 1, 1, 0, 1, start)
+    def term(self, n):
+        return fib(n)
+    def __iter__(self):
+        a, b = fib_pair(self.start)
+        while True:
+            yield a
+            a, b = b, a + b
+    def skip(self, count):
+        return Fibonacci(self.start + count)
+
+if __name__ == '__main__':
+    from jtest import BaseTest, returns, raises, color
+    from itertools import islice
+    import sys
+
+    class Test(BaseTest):
+        pass
+
+    class TestFibonacci(Test):
+        @returns([0, 1, 1, 2, 3, 5, 8, 13, 21, 34])
+        def fib(self):
+            return [fib(n) for n in xrange(10)]
+        @returns(True)
+        def fib_large(self):
+            a, b = 0, 1
+            for _ in xrange(1000):
+                a, b = b, a + b
+            return fib(1000) == a
+        @raises(ValueError)
+        def fib_negative(self):
+            return fib(-1)
+        @returns([1, 1, 2, 3, 5])
+        def sequence(self):
+            return list(islice(Fibonacci(1), 5))
+        @returns(([55, 89, 144], 89))
+        def skip(self):
+            s = Fibonacci(1).skip(9)
+            return list(islice(s, 3)), s[1]
+        @returns(True)
+        def digits(self):
+            return all(fib_digits(n) == len(str(fib(n))) for n in xrange(1, 2000))
+        @returns([1, 7, 12, 4782])
+        def index_with_digits(self):
+            return [fib_index_with_digits(d) for d in (1, 2, 3, 1000)]
+        @returns(47847)
+        def index_with_digits_large(self):
+            return fib_index_with_digits(10000)
+
+    class TestRecurrence(Test):
+        @returns([2, 1, 3, 4, 7, 11, 18])
+        def lucas(self):
+            return list(islice(Recurrence(1, 1, 2, 1), 7))
+        @returns(([4, 7, 11], 11))
+        def lucas_skip(self):
+            s = Recurrence(1, 1, 2, 1).skip(3)
+            return list(islice(s, 3)), s[2]
+        @returns([0, 1, 2, 5, 12, 29])
+        def pell(self):
+            return [Recurrence(2, 1, 0, 1)[n] for n in xrange(6)]
+
+    color.ENABLED = sys.stdout.isatty()
+    BaseTest.run_all_tests(base_class=Test, g=globals())
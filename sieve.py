@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+from itertools import compress, islice
+import math
+
+# Segmented sieve of Eratosthenes over odd numbers. Every segment is a bytearray
+# of SEGMENT flags, one per odd number, so memory stays bounded no matter how far
+# the sieve runs; the base primes needed for crossing off (up to the square root
+# of the segment's end) come from a plain sieve that is regrown as needed.
+
+SEGMENT = 1 << 16
+
+def isqrt(n):
+    r = int(math.sqrt(n))
+    while r * r > n:
+        r -= 1
+    while (r + 1) * (r + 1) <= n:
+        r += 1
+    return r
+
+def small_primes(n):
+    'n -> list of odd primes below n'
+    sieve = bytearray([1]) * (n // 2)
+    if sieve:
+        sieve[0] = 0
+    for i in xrange(1, (isqrt(n) + 1) // 2):
+        if sieve[i]:
+            p = 2 * i + 1
+            start = p * p // 2
+            sieve[start::p] = bytearray(len(xrange(start, len(sieve), p)))
+    return [2 * i + 1 for i in compress(xrange(len(sieve)), sieve)]
+
+def segmented_sieve(limit=None):
+    if limit is not None and limit <= 2:
+        return
+    yield 2
+    low = 3
+    base, base_limit = [], 0
+    while limit is None or low < limit:
+        high = low + 2 * SEGMENT if limit is None else min(low + 2 * SEGMENT, limit)
+        root = isqrt(high - 1)
+        if root >= base_limit:
+            base_limit = max(2 * root, 1024)
+            base = small_primes(base_limit + 1)
+        size = (high - low + 1) // 2
+        segment = bytearray([1]) * size
+        for p in base:
+            start = p * p
+            if start >= high:
+                break
+            if start < low:
+                start = (low + p - 1) // p * p
+                if not start & 1:
+                    start += p
+            j = (start - low) // 2
+            if j < size:
+                segment[j::p] = bytearray((size - 1 - j) // p + 1)
+        for n in compress(xrange(low, low + 2 * size, 2), segment):
+            yield n
+        low += 2 * size
+
+def primes():
+    '-> all primes, in increasing order'
+    return segmented_sieve()
+
+def primes_below(n):
+    'n -> all primes below n, in increasing order'
+    return segmented_sieve(n)
+
+def nth_prime(n):
+    "n -> n'th prime, counting from nth_prime(1) == 2"
+    if n < 1:
+        raise ValueError('No prime with index {0}'.format(n))
+    bound = 15 if n < 6 else int(n * (math.log(n) + math.log(math.log(n)))) + 1
+    return next(islice(primes_below(bound), n - 1, None))
+
+if __name__ == '__main__':
+    from jtest import BaseTest, returns, raises, color
+    import sys
+
+    def trial_division(n):
+        return [i for i in xrange(2, n) if all(i % d for d in xrange(2, isqrt(i) + 1))]
+
+    class Test(BaseTest):
+        pass
+
+    class TestSieve(Test):
+        @returns([2, 3, 5, 7, 11, 13, 17, 19, 23, 29])
+        def primes(self):
+            return list(islice(primes(), 10))
+        @returns([2, 3, 5, 7, 11, 13, 17, 19, 23, 29])
+        def primes_below_1(self):
+            return list(primes_below(30))
+        @returns([[], [], [], [2], [2, 3]])
+        def primes_below_2(self):
+            return [list(primes_below(n)) for n in xrange(5)]
+        @returns(True)
+        def segments(self):
+            return list(primes_below(150000)) == trial_division(150000)
+        @returns(78498)
+        def count(self):
+            return sum(1 for p in primes_below(10 ** 6))
+        @returns([2, 3, 5, 13, 104743])
+        def nth_prime_1(self):
+            return [nth_prime(n) for n in (1, 2, 3, 6, 10001)]
+        @raises(ValueError)
+        def nth_prime_2(self):
+            return nth_prime(0)
+        @returns(142913828922)
+        def sum_below(self):
+            return sum(primes_below(2000000))
+
+    color.ENABLED = sys.stdout.isatty()
+    BaseTest.run_all_tests(base_class=Test, g=globals())